@@ -1,12 +1,22 @@
 import streamlit as st
-import google.generativeai as genai
-import openai
-import anthropic
-import json
+import asyncio
+import bcrypt
+import blake3
+import collections
+import functools
+import ijson
+import orjson
 import time
 from datetime import datetime
 import re
-from typing import Dict, List, Optional
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+if TYPE_CHECKING:
+    # 型注釈用（実行時は各SDKを遅延インポートする）
+    import anthropic
+    import google.generativeai as genai
+    import openai
 
 # --- ページ設定 ---
 st.set_page_config(
@@ -102,10 +112,24 @@ st.markdown("""
 
 # --- ユーティリティ関数 ---
 
+ENGAGING_WORDS = ["しかし", "だが", "突然", "ついに", "果たして", "なぜなら", "そして", "もし", "驚くべきことに"]
+FANTASY_KEYWORDS = ["魔法", "異世界", "ドラゴン", "冒険"]
+
+_WORD_RE = re.compile(r'\b\w+\b')
+# あらすじ品質の判定対象（引きのある語・感嘆/疑問符・ファンタジー要素）を1回の走査で拾うための複合パターン
+# 先読みにすることで「もしかして」の中の「しかし」のような重なった出現も拾う
+_QUALITY_RE = re.compile('(?=' + '|'.join(
+    [f'(?P<engaging{i}>{re.escape(word)})' for i, word in enumerate(ENGAGING_WORDS)]
+    + ['(?P<punctuation>[?！])', '(?P<fantasy>' + '|'.join(map(re.escape, FANTASY_KEYWORDS)) + ')']
+) + ')')
+# 「。」で区切った各文のうち空白以外を含むものに1回ずつマッチする
+_SENTENCE_RE = re.compile(r'[^。\s][^。]*')
+
 def count_tokens(text: str) -> int:
     """テキストのトークン数を推定（日本語対応）"""
-    japanese_chars = len([c for c in text if ord(c) > 127])
-    english_words = len(re.findall(r'\b\w+\b', text))
+    # ASCII以外の文字数を、ASCII部分だけをエンコードした長さとの差で数える（ループはC側で処理される）
+    japanese_chars = len(text) - len(text.encode('ascii', 'ignore'))
+    english_words = len(_WORD_RE.findall(text))
     estimated_tokens = int(japanese_chars * 1.5 + english_words * 1.3)
     if len(text) > 500:
         estimated_tokens += len(text) // 10
@@ -127,154 +151,441 @@ def log_api_usage(prompt: str, response: str, model_name: str, prompt_tokens: in
         'response_tokens': response_tokens,
         'total_tokens': total_tokens
     })
-    
-    if len(st.session_state.api_usage['request_history']) > 100:
-        st.session_state.api_usage['request_history'] = st.session_state.api_usage['request_history'][-100:]
+
+_MODEL_NAMES = {"Gemini": "gemini-2.0-flash", "OpenAI": "gpt-4o-mini", "Claude": "claude-3-haiku-20240307"}
 
 def get_model_name(provider: str) -> str:
-    if provider == "Gemini":
-        return "gemini-2.0-flash"
-    elif provider == "OpenAI":
-        return "gpt-4o-mini"
-    elif provider == "Claude":
-        return "claude-3-haiku-20240307"
-    return ""
+    return _MODEL_NAMES.get(provider, "")
 
+@st.cache_data(show_spinner=False, ttl=24 * 60 * 60, max_entries=256)
 def analyze_synopsis_quality(synopsis: str) -> int:
-    """あらすじの品質を簡易分析"""
+    """あらすじの品質を簡易分析（同じあらすじは再実行のたびに再計算しない）"""
     score = 0
     if 200 <= len(synopsis) <= 400: score += 30
     elif 150 <= len(synopsis) <= 500: score += 20
     else: score += 10
     
-    engaging_words = ["しかし", "だが", "突然", "ついに", "果たして", "なぜなら", "そして", "もし", "驚くべきことに"]
-    for word in engaging_words:
-        if word in synopsis: score += 5
+    found = {match.lastgroup for match in _QUALITY_RE.finditer(synopsis)}
+    
+    # 含まれている語の種類数で加点（同じ語の繰り返しは加点しない）
+    score += sum(1 for group in found if group.startswith("engaging")) * 5
     
-    if "?" in synopsis or "！" in synopsis: score += 10
+    if "punctuation" in found: score += 10
     
-    if any(keyword in synopsis for keyword in ["魔法", "異世界", "ドラゴン", "冒険"]): score += 15
+    if "fantasy" in found: score += 15
     
-    sentences = synopsis.split("。")
-    sentences = [s.strip() for s in sentences if s.strip()]
-    if 3 <= len(sentences) <= 6: score += 20
+    sentence_count = sum(1 for _ in _SENTENCE_RE.finditer(synopsis))
+    if 3 <= sentence_count <= 6: score += 20
     
     return min(score, 100)
 
+def save_chapter(project: dict, name: str, body: str):
+    """章の本文を保存し、一覧表示用のメタ情報（章名・文字数・更新日時）を更新"""
+    meta = {'name': name, 'length': len(body), 'updated_at': datetime.now().isoformat()}
+    if name in project['chapters_body']:
+        project['chapters_meta'] = [meta if m['name'] == name else m for m in project['chapters_meta']]
+    else:
+        project['chapters_meta'].append(meta)
+    project['chapters_body'][name] = body
+
+def migrate_chapters(project: dict):
+    """旧形式の chapters（章名 -> 本文の辞書）を chapters_meta と chapters_body に分ける"""
+    if 'chapters_meta' in project:
+        return
+    project['chapters_meta'] = []
+    project['chapters_body'] = {}
+    for name, body in project.pop('chapters', {}).items():
+        save_chapter(project, name, body)
+
+def serialize_projects(projects: dict) -> bytes:
+    """全プロジェクトをエクスポート用のJSON（UTF-8バイト列）に変換"""
+    return orjson.dumps(projects, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
 # --- マルチAIモデル API呼び出し関数 ---
 
-def call_generative_api(prompt: str) -> Dict:
-    """選択されたAIモデルのAPIを呼び出す統一関数"""
-    model_provider = st.session_state.get('selected_model_provider', 'Gemini')
-    # session_state からユーザー固有のAPIキーを取得
-    api_keys = st.session_state.get('user_api_keys', {})
-    
-    model_name = get_model_name(model_provider)
-    
-    try:
-        response_text = "エラー: 想定外のプロバイダーです。"
-        prompt_tokens = 0
-        response_tokens = 0
-
-        if model_provider == "Gemini":
-            api_key = api_keys.get('gemini')
-            if not api_key: return {"text": "エラー: Gemini APIキーが設定されていません。", "prompt_tokens": 0, "response_tokens": 0}
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel(model_name)
-            
-            prompt_tokens = count_tokens(prompt)
-            
-            response = model.generate_content(prompt)
-            response_text = response.text
-            response_tokens = count_tokens(response_text)
-
-        elif model_provider == "OpenAI":
-            api_key = api_keys.get('openai')
-            if not api_key: return {"text": "エラー: OpenAI APIキーが設定されていません。", "prompt_tokens": 0, "response_tokens": 0}
-            client = openai.OpenAI(api_key=api_key)
-            
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            response_text = response.choices[0].message.content
-            prompt_tokens = response.usage.prompt_tokens
-            response_tokens = response.usage.completion_tokens
-
-        elif model_provider == "Claude":
-            api_key = api_keys.get('claude')
-            if not api_key: return {"text": "エラー: Anthropic (Claude) APIキーが設定されていません。", "prompt_tokens": 0, "response_tokens": 0}
-            client = anthropic.Anthropic(api_key=api_key)
-            
-            response = client.messages.create(
-                model=model_name,
-                max_tokens=4096,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            response_text = response.content[0].text
-            prompt_tokens = response.usage.input_tokens
-            response_tokens = response.usage.output_tokens
-        
-        else:
-            return {"text": "エラー: 不明なAIモデルが選択されています。", "prompt_tokens": 0, "response_tokens": 0}
+@st.cache_resource(show_spinner=False)
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """API呼び出し用のイベントループ（プロセス内で共有し、クライアントの接続を再利用できるようにする）"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="ai-api-event-loop", daemon=True).start()
+    return loop
+
+def _run_async(coro):
+    """共有イベントループ上でコルーチンを実行し、結果を待つ"""
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop()).result()
+
+# 各プロバイダーのSDKは読み込みが重いため、実際に使われるときに初めてインポートする
+@functools.lru_cache(maxsize=1)
+def _get_genai():
+    import google.generativeai as genai
+    return genai
+
+@functools.lru_cache(maxsize=1)
+def _get_openai():
+    import openai
+    return openai
+
+@functools.lru_cache(maxsize=1)
+def _get_anthropic():
+    import anthropic
+    return anthropic
+
+# pandas もキャラクター一覧の表示でしか使わないため、必要になるまで読み込まない
+@functools.lru_cache(maxsize=1)
+def _get_pandas():
+    import pandas
+    return pandas
+
+# SDKのクライアントはAPIキーごとに使い回す（接続プールは各SDKのクライアントが保持する）
+@st.cache_resource(show_spinner=False)
+def _openai_client(api_key: str) -> "openai.AsyncOpenAI":
+    return _get_openai().AsyncOpenAI(api_key=api_key)
+
+@st.cache_resource(show_spinner=False)
+def _anthropic_client(api_key: str) -> "anthropic.AsyncAnthropic":
+    return _get_anthropic().AsyncAnthropic(api_key=api_key)
+
+@st.cache_resource(show_spinner=False)
+def _gemini_lock() -> threading.Lock:
+    return threading.Lock()
+
+@st.cache_resource(show_spinner=False)
+def _gemini_model(api_key: str) -> "genai.GenerativeModel":
+    """APIキーごとに Gemini のモデルを作る（genai の設定はプロセス全体で共有されるため、作成時にそのキーのクライアントを結び付ける）"""
+    genai = _get_genai()
+    from google.generativeai import client as genai_client
+    with _gemini_lock():
+        # configure() は既定のクライアントを破棄するので、直後に取得したクライアントはこのキーで作られる
+        genai.configure(api_key=api_key)
+        model = genai.GenerativeModel(_MODEL_NAMES["Gemini"])
+        model._async_client = genai_client.get_default_generative_async_client()
+    return model
+
+async def _call_gemini(prompt: str, api_key: str) -> Dict:
+    if not api_key: return {"text": "エラー: Gemini APIキーが設定されていません。", "prompt_tokens": 0, "response_tokens": 0}
+    model = _gemini_model(api_key)
+
+    prompt_tokens = count_tokens(prompt)
+
+    response = await model.generate_content_async(prompt)
+    response_text = response.text
+    return {"text": response_text, "prompt_tokens": prompt_tokens, "response_tokens": count_tokens(response_text)}
+
+async def _call_openai(prompt: str, api_key: str) -> Dict:
+    if not api_key: return {"text": "エラー: OpenAI APIキーが設定されていません。", "prompt_tokens": 0, "response_tokens": 0}
+    response = await _openai_client(api_key).chat.completions.create(
+        model=_MODEL_NAMES["OpenAI"],
+        messages=[{"role": "user", "content": prompt}]
+    )
+    return {"text": response.choices[0].message.content,
+            "prompt_tokens": response.usage.prompt_tokens,
+            "response_tokens": response.usage.completion_tokens}
+
+async def _call_claude(prompt: str, api_key: str) -> Dict:
+    if not api_key: return {"text": "エラー: Anthropic (Claude) APIキーが設定されていません。", "prompt_tokens": 0, "response_tokens": 0}
+    response = await _anthropic_client(api_key).messages.create(
+        model=_MODEL_NAMES["Claude"],
+        max_tokens=4096,
+        messages=[{"role": "user", "content": prompt}]
+    )
+    return {"text": response.content[0].text,
+            "prompt_tokens": response.usage.input_tokens,
+            "response_tokens": response.usage.output_tokens}
+
+# 修正（リライト）用の呼び出し: 修正前の文章を別に渡し、変更のない部分の生成・入力処理を省く
+async def _revise_openai(instruction: str, original: str, api_key: str) -> Dict:
+    if not api_key: return {"text": "エラー: OpenAI APIキーが設定されていません。", "prompt_tokens": 0, "response_tokens": 0}
+    # 修正前の文章を予測出力（Predicted Outputs）として渡し、一致する部分の生成を省略させる
+    response = await _openai_client(api_key).chat.completions.create(
+        model=_MODEL_NAMES["OpenAI"],
+        messages=[{"role": "system", "content": instruction}, {"role": "user", "content": original}],
+        prediction={"type": "content", "content": original},
+        temperature=0.2
+    )
+    return {"text": response.choices[0].message.content,
+            "prompt_tokens": response.usage.prompt_tokens,
+            "response_tokens": response.usage.completion_tokens}
+
+async def _revise_claude(instruction: str, original: str, api_key: str) -> Dict:
+    if not api_key: return {"text": "エラー: Anthropic (Claude) APIキーが設定されていません。", "prompt_tokens": 0, "response_tokens": 0}
+    # 修正前の文章をキャッシュ対象のシステムプロンプトに置き、同じ文章への修正指示の繰り返しで再利用する
+    response = await _anthropic_client(api_key).messages.create(
+        model=_MODEL_NAMES["Claude"],
+        max_tokens=4096,
+        system=[{"type": "text", "text": original, "cache_control": {"type": "ephemeral"}}],
+        messages=[{"role": "user", "content": instruction}]
+    )
+    return {"text": response.content[0].text,
+            "prompt_tokens": response.usage.input_tokens,
+            "response_tokens": response.usage.output_tokens}
 
-        log_api_usage(prompt, response_text, model_name, prompt_tokens, response_tokens)
-        
-        st.session_state.current_call_token_info = {
-            "model": model_name,
-            "prompt_tokens": prompt_tokens,
-            "response_tokens": response_tokens,
-            "total_tokens": prompt_tokens + response_tokens
-        }
+async def _stream_gemini(prompt: str, api_key: str, usage: Dict):
+    if not api_key:
+        yield "エラー: Gemini APIキーが設定されていません。"
+        return
+    model = _gemini_model(api_key)
 
-        return {"text": response_text, "prompt_tokens": prompt_tokens, "response_tokens": response_tokens}
+    response = await model.generate_content_async(prompt, stream=True)
+    async for chunk in response:
+        yield chunk.text
 
-    except Exception as e:
-        error_message = f"API呼び出し中にエラーが発生しました: {str(e)}"
+async def _stream_openai(prompt: str, api_key: str, usage: Dict):
+    if not api_key:
+        yield "エラー: OpenAI APIキーが設定されていません。"
+        return
+    stream = await _openai_client(api_key).chat.completions.create(
+        model=_MODEL_NAMES["OpenAI"],
+        messages=[{"role": "user", "content": prompt}],
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+        if chunk.usage:
+            usage['prompt_tokens'] = chunk.usage.prompt_tokens
+            usage['response_tokens'] = chunk.usage.completion_tokens
+
+async def _stream_claude(prompt: str, api_key: str, usage: Dict):
+    if not api_key:
+        yield "エラー: Anthropic (Claude) APIキーが設定されていません。"
+        return
+    async with _anthropic_client(api_key).messages.stream(
+        model=_MODEL_NAMES["Claude"],
+        max_tokens=4096,
+        messages=[{"role": "user", "content": prompt}]
+    ) as stream:
+        async for text in stream.text_stream:
+            yield text
+        final_message = await stream.get_final_message()
+    usage['prompt_tokens'] = final_message.usage.input_tokens
+    usage['response_tokens'] = final_message.usage.output_tokens
+
+MAX_CONCURRENT_API_CALLS = 4 # 一括生成（作品全体の各章など）で同時に送る呼び出しの上限
+
+# プロバイダー名 -> 呼び出し関数（プロバイダーの追加はここに登録するだけでよい）
+_PROVIDER_HANDLERS = {"Gemini": _call_gemini, "OpenAI": _call_openai, "Claude": _call_claude}
+_STREAM_HANDLERS = {"Gemini": _stream_gemini, "OpenAI": _stream_openai, "Claude": _stream_claude}
+_REVISION_HANDLERS = {"OpenAI": _revise_openai, "Claude": _revise_claude}
+
+async def _acall(provider: str, prompt: str, api_key: str) -> Dict:
+    """選択されたAIモデルのAPIを非同期で呼び出す（通信エラーは呼び出し元で処理）"""
+    handler = _PROVIDER_HANDLERS.get(provider)
+    if handler is None:
+        return {"text": "エラー: 不明なAIモデルが選択されています。", "prompt_tokens": 0, "response_tokens": 0}
+    return await handler(prompt, api_key)
+
+def _revision_prompt(instruction: str, original: str, content_type: str) -> str:
+    """修正指示と修正前の文章を1つのプロンプトにまとめる（専用の修正呼び出しがないプロバイダー用）"""
+    return f"{instruction}\n【現在の{content_type}】\n{original}"
+
+async def _arevise(provider: str, instruction: str, original: str, content_type: str, api_key: str) -> Dict:
+    """修正前の文章を指示に従って書き直す（専用の呼び出しがないプロバイダーは通常の呼び出しで全文を生成）"""
+    handler = _REVISION_HANDLERS.get(provider)
+    if handler is None:
+        return await _acall(provider, _revision_prompt(instruction, original, content_type), api_key)
+    return await handler(instruction, original, api_key)
+
+async def _astream(provider: str, prompt: str, api_key: str, usage: Dict):
+    """選択されたAIモデルの応答を逐次受け取る非同期ジェネレーター（使用量が返れば usage に格納）"""
+    handler = _STREAM_HANDLERS.get(provider)
+    if handler is None:
+        yield "エラー: 不明なAIモデルが選択されています。"
+        return
+    async for chunk in handler(prompt, api_key, usage):
+        yield chunk
+
+def _iter_async(agen):
+    """非同期ジェネレーターを共有イベントループ上で進め、同期的に1要素ずつ取り出す"""
+    try:
+        while True:
+            try:
+                yield _run_async(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        _run_async(agen.aclose())
+
+def _error_result(error: Exception) -> Dict:
+    # 本文と区別できるよう、他のエラーと同じく「エラー」で始める
+    return {"text": f"エラー: API呼び出し中に問題が発生しました: {str(error)}", "prompt_tokens": 0, "response_tokens": 0, "error": str(error)}
+
+async def _agather(provider: str, prompts: List[str], api_key: str, max_concurrent_tasks: int = MAX_CONCURRENT_API_CALLS) -> List[Dict]:
+    """複数のプロンプトを並行して呼び出す（同一プロンプトは1回の呼び出しに集約）"""
+    in_flight: Dict[str, asyncio.Task] = {}
+    lock = asyncio.Lock()
+    # プロバイダーのレート制限（RPM）を超えないよう、同時に実行する呼び出し数を制限する
+    semaphore = asyncio.Semaphore(max_concurrent_tasks)
+
+    async def _limited_call(prompt: str) -> Dict:
+        async with semaphore:
+            return await _acall(provider, prompt, api_key)
+
+    async def _dedup_call(prompt: str) -> Dict:
+        key = blake3.blake3(prompt.encode("utf-8")).hexdigest()
+        async with lock:
+            task = in_flight.get(key)
+            if task is None:
+                task = in_flight[key] = asyncio.ensure_future(_limited_call(prompt))
+        return await task
+
+    results = await asyncio.gather(*(_dedup_call(prompt) for prompt in prompts), return_exceptions=True)
+    return [_error_result(result) if isinstance(result, Exception) else result for result in results]
+
+def _api_key_fingerprint(api_key: str) -> str:
+    """キャッシュキー用にAPIキーのハッシュ先頭部分を返す（キー自体はキャッシュに含めない）"""
+    return blake3.blake3((api_key or '').encode("utf-8")).hexdigest()[:16]
+
+def _blake3_digest(text: str) -> bytes:
+    """長いプロンプトのキャッシュキー用ハッシュ（sha256 より高速な blake3 を使う）"""
+    return blake3.blake3(text.encode("utf-8")).digest()
+
+_CACHE_HASH_FUNCS = {str: _blake3_digest}
+
+@st.cache_data(ttl=3600, show_spinner=False, hash_funcs=_CACHE_HASH_FUNCS)
+def _cached_llm_call(provider: str, model: str, prompt: str, api_key_fingerprint: str, _api_key: str) -> Dict:
+    """API応答をキャッシュする（例外はキャッシュされない）"""
+    # 同じ引数の呼び出しが同時に来ても、cache_data がキーごとにロックするので送信は1回になる
+    return _run_async(_acall(provider, prompt, _api_key))
+
+@st.cache_data(ttl=3600, show_spinner=False, hash_funcs=_CACHE_HASH_FUNCS)
+def _cached_llm_revision(provider: str, model: str, instruction: str, original: str, content_type: str, api_key_fingerprint: str, _api_key: str) -> Dict:
+    """修正（リライト）の応答をキャッシュする（例外はキャッシュされない）"""
+    return _run_async(_arevise(provider, instruction, original, content_type, _api_key))
+
+def get_api_key(provider: str) -> str:
+    """サイドバーの入力欄（session_state）から現在のユーザーのAPIキーを取得"""
+    return st.session_state.get(f"api_key_{provider.lower()}_{st.session_state.get('current_user')}", '')
+
+def _record_api_result(model_name: str, prompt: str, result: Dict):
+    """API呼び出し結果をトークン使用量とサイドバー表示に反映"""
+    if 'error' in result:
         st.session_state.current_call_token_info = {
             "model": model_name,
             "prompt_tokens": 0,
             "response_tokens": 0,
             "total_tokens": 0,
-            "error": str(e)
+            "error": result['error']
         }
-        return {"text": error_message, "prompt_tokens": 0, "response_tokens": 0}
+        return
+    if result['text'].startswith("エラー"):
+        return
 
-# --- AIコンテンツ生成関数 ---
+    log_api_usage(prompt, result['text'], model_name, result['prompt_tokens'], result['response_tokens'])
 
-def generate_ai_content(content_type: str, project_data: dict, additional_params: dict = None) -> str:
-    """AI コンテンツ生成の統一関数"""
-    base_info = f"""
+    st.session_state.current_call_token_info = {
+        "model": model_name,
+        "prompt_tokens": result['prompt_tokens'],
+        "response_tokens": result['response_tokens'],
+        "total_tokens": result['prompt_tokens'] + result['response_tokens']
+    }
+
+def call_generative_api_batch(prompts: List[str]) -> List[Dict]:
+    """選択されたAIモデルに複数のプロンプトを並行して送信する"""
+    model_provider = st.session_state.get('selected_model_provider', 'Gemini')
+    model_name = get_model_name(model_provider)
+
+    results = _run_async(_agather(model_provider, prompts, get_api_key(model_provider)))
+
+    # 重複プロンプトは同じ結果オブジェクトを共有するため、使用量は1回だけ記録する
+    recorded = set()
+    for prompt, result in zip(prompts, results):
+        if id(result) not in recorded:
+            recorded.add(id(result))
+            _record_api_result(model_name, prompt, result)
+
+    return results
+
+def call_generative_api(prompt: str) -> Dict:
+    """選択されたAIモデルのAPIを呼び出す統一関数（同一プロンプトの応答はキャッシュから返す）"""
+    model_provider = st.session_state.get('selected_model_provider', 'Gemini')
+    api_key = get_api_key(model_provider)
+
+    model_name = get_model_name(model_provider)
+
+    try:
+        result = _cached_llm_call(model_provider, model_name, prompt, _api_key_fingerprint(api_key), api_key)
+    except Exception as e:
+        result = _error_result(e)
+
+    # キャッシュヒット時もトークン使用量は記録する
+    _record_api_result(model_name, prompt, result)
+    return result
+
+def call_generative_api_revision(instruction: str, original: str, content_type: str = "テキスト") -> Dict:
+    """修正前の文章 original を指示 instruction に従って書き直す（差分だけを生成できるプロバイダーではそれを利用）"""
+    model_provider = st.session_state.get('selected_model_provider', 'Gemini')
+    api_key = get_api_key(model_provider)
+
+    model_name = get_model_name(model_provider)
+
+    try:
+        result = _cached_llm_revision(model_provider, model_name, instruction, original, content_type, _api_key_fingerprint(api_key), api_key)
+    except Exception as e:
+        result = _error_result(e)
+
+    _record_api_result(model_name, _revision_prompt(instruction, original, content_type), result)
+    return result
+
+def call_generative_api_stream(prompt: str, result: Optional[Dict] = None):
+    """選択されたAIモデルの応答を逐次返すジェネレーター（完了後、result に応答全体と使用量を格納）"""
+    # 逐次表示する生成（あらすじ・世界観・章・総合診断・改善提案）はキャッシュせず、毎回新しく生成する
+    model_provider = st.session_state.get('selected_model_provider', 'Gemini')
+    model_name = get_model_name(model_provider)
+    if result is None:
+        result = {}
+
+    usage = {}
+    chunks = []
+    try:
+        for chunk in _iter_async(_astream(model_provider, prompt, get_api_key(model_provider), usage)):
+            chunks.append(chunk)
+            yield chunk
+    except Exception as e:
+        result.update(_error_result(e))
+    else:
+        response_text = "".join(chunks)
+        # 使用量を返さないプロバイダーは推定値で記録する
+        result.update({
+            "text": response_text,
+            "prompt_tokens": usage['prompt_tokens'] if 'prompt_tokens' in usage else count_tokens(prompt),
+            "response_tokens": usage['response_tokens'] if 'response_tokens' in usage else count_tokens(response_text)
+        })
+
+    _record_api_result(model_name, prompt, result)
+
+# --- プロンプトテンプレート ---
+
+_BASE_INFO_TEMPLATE = """
 作品基本情報:
-- ジャンル: {project_data.get('genre', '未設定')}
-- ターゲット読者: {project_data.get('target_audience', '未設定')}
-- テーマ: {project.get('theme', '未設定')}
-- あらすじ: {project.get('synopsis', '未設定')}
-- 世界観: {project.get('world_setting', '未設定')[:500]}
+- ジャンル: {genre}
+- ターゲット読者: {target_audience}
+- テーマ: {theme}
+- あらすじ: {synopsis}
+- 世界観: {world}
 """
-    prompt = ""
-    if content_type == "synopsis":
-        prompt = f"""
+
+_CONTENT_TEMPLATES = {
+    "synopsis": """
 魅力的なライトノベルのあらすじを作成してください。
 
 {base_info}
-追加設定: {additional_params.get('custom_elements', '') if additional_params else ''}
+追加設定: {custom_elements}
 
 要求:
 1. 200-400文字の簡潔なあらすじ
 2. 読者の興味を引く内容
 3. 続きが気になる構成
 4. 完成度の高い、魅力的な品質で作成してください。
-"""
-    elif content_type == "character":
-        prompt = f"""
+""",
+    "character": """
 魅力的なライトノベルのキャラクターを作成してください。
 
 {base_info}
 キャラクター要求:
-- 名前: {additional_params.get('char_name', '') if additional_params else ''}
-- 役割: {additional_params.get('char_role', '') if additional_params else ''}
-- 追加要求: {additional_params.get('char_details', '') if additional_params else ''}
+- 名前: {char_name}
+- 役割: {char_role}
+- 追加要求: {char_details}
 
 作成項目:
 1. 詳細な性格設定
@@ -285,13 +596,12 @@ def generate_ai_content(content_type: str, project_data: dict, additional_params
 6. 他キャラとの関係性
 
 読者に愛される魅力的なキャラクターを設計してください。
-"""
-    elif content_type == "world_setting":
-        prompt = f"""
+""",
+    "world_setting": """
 独創的で魅力的な世界観を構築してください。
 
 {base_info}
-世界観要求: {additional_params.get('world_elements', '') if additional_params else ''}
+世界観要求: {world_elements}
 
 構築項目:
 1. 世界の基本ルール・法則
@@ -303,22 +613,16 @@ def generate_ai_content(content_type: str, project_data: dict, additional_params
 7. 技術レベル
 
 既存作品との差別化を意識した独創的な世界観を作成してください。
-"""
-    elif content_type == "chapter":
-        char_info = ""
-        if project_data.get('characters'):
-            char_list_display = list(project_data['characters'].keys())[:5]
-            char_info = f"\n主要キャラクター（抜粋）:\n{', '.join(char_list_display)}"
-        
-        prompt = f"""
+""",
+    "chapter": """
 読者を引き込む魅力的な章を執筆してください。
 
 {base_info}{char_info}
 章の設定:
-- チャプター名/番号: {additional_params.get('chapter_name', '第X章') if additional_params else '第X章'}
-- プロット概要: {additional_params.get('chapter_plot', '指定なし') if additional_params else '指定なし'}
-- 文字数目標: {additional_params.get('target_length', '3000-5000') if additional_params else '3000-5000'}文字
-- 文体: {additional_params.get('writing_style', '三人称') if additional_params else '三人称'}
+- チャプター名/番号: {chapter_name}
+- プロット概要: {chapter_plot}
+- 文字数目標: {target_length}文字
+- 文体: {writing_style}
 
 執筆要求:
 1. 魅力的な導入
@@ -328,17 +632,13 @@ def generate_ai_content(content_type: str, project_data: dict, additional_params
 5. 完成度の高い文章力
 
 多くの読者に楽しんでもらえる品質で執筆してください。
-"""
-    elif content_type == "full_story":
-        prompt = f"""
-完全なライトノベル作品を執筆してください。
+""",
+}
 
-{base_info}
-執筆要求:
-- 文字数: {additional_params.get('target_length', '10000-15000') if additional_params else '10000-15000'}文字
-- 章数: {additional_params.get('chapter_count', '3-5') if additional_params else '3-5'}章構成
-- 文体: {additional_params.get('writing_style', '三人称') if additional_params else '三人称'}
+_FULL_STORY_OUTLINE_TEMPLATE = """
+ライトノベル作品の全{chapter_total}章の章構成を作成してください。
 
+{base_info}
 構成:
 1. 魅力的なプロローグ
 2. キャラクター紹介と世界観提示
@@ -346,23 +646,301 @@ def generate_ai_content(content_type: str, project_data: dict, additional_params
 4. 展開・クライマックス
 5. 解決・エピローグ
 
-素晴らしい品質で作成してください。各章の終わりに【第○章 終了】と明記してください。
+各章を「第1章: 章タイトル - この章の概要（2〜3文）」の形式で1行ずつ、全{chapter_total}行だけ出力してください。
 """
 
-    api_response = call_generative_api(prompt)
+_FULL_STORY_CHAPTER_TEMPLATE = """
+完全なライトノベル作品の第{chapter_index}章（全{chapter_total}章構成）を執筆してください。
+
+{base_info}
+作品全体の章構成:
+{outline}
+
+この章の内容: {chapter_plan}
+
+執筆要求:
+- 作品全体の文字数: {target_length}文字（この章はその約{chapter_total}分の1）
+- 文体: {writing_style}
+- 前後の章と話がつながるよう、章構成に沿って執筆してください。
+
+素晴らしい品質で作成してください。章の本文のみを出力し、章の終了表記は不要です。
+"""
+
+# テーマ・あらすじ・世界観の一括生成用（区切り行で応答を分割する）
+_INITIAL_PACK_TEMPLATE = """
+ライトノベル作品の初期設定として、テーマ・あらすじ・世界観をまとめて作成してください。
+
+共通前提:
+- ジャンル: {genre}
+- ターゲット読者: {target_audience}
+- 作品の雰囲気: {tone}
+- あらすじへの追加要望: {custom_elements}
+- 世界観に追加したい要素: {world_elements}
+
+以下の3つの区切り行をこの順番でそのまま出力し、それぞれの直後に内容を書いてください。区切り行以外の前置きや説明は不要です。
+###THEME###
+ライトノベルの読者が興味を惹かれるような魅力的なテーマを1つ、15文字以内で簡潔に
+###SYNOPSIS###
+200-400文字の簡潔なあらすじ（読者の興味を引き、続きが気になる構成で）
+###WORLD###
+世界の基本ルール・歴史・政治や社会・魔法や超能力（該当する場合）・地理・文化・技術レベルを含む、既存作品と差別化された独創的な世界観
+"""
+_INITIAL_PACK_SECTION_RE = re.compile(r'^[ \t]*###(THEME|SYNOPSIS|WORLD)###[ \t]*$', re.MULTILINE)
+_INITIAL_PACK_FIELDS = {"THEME": "theme", "SYNOPSIS": "synopsis", "WORLD": "world_setting"}
+
+# キャラクター詳細設定の生成用
+_CHARACTER_DETAIL_TEMPLATE = """
+以下の情報を基に、ライトノベルのキャラクター設定を詳細に生成してください。
+キャラクター名: {char_name}
+役割: {char_role}
+要望: {char_details}
+
+生成項目:
+1. 詳細な性格設定（長所、短所、癖など）
+2. 背景・過去（物語に影響を与える要素）
+3. 目標・動機
+4. 外見的特徴（髪の色、目の色、体格、服装など）
+5. 口調・話し方
+6. 他キャラクターとの関係性（想定されるもの）
+7. そのキャラクターを表す象徴的なアイテムや能力（あれば）
+
+読者に愛されるような、深みのあるキャラクター設定を作成してください。
+"""
+
+# 作品総合診断・改善提案用（world は先頭1000文字、characters は主要キャラクターの役割一覧）
+_DIAGNOSIS_TEMPLATE = """
+あなたは経験豊富なライトノベルの編集者です。以下の作品設定とあらすじ、キャラクター情報を分析し、読者を惹きつけるレベルに達しているか、多角的な視点から評価・診断してください。
+
+【作品基本情報】
+ジャンル: {genre}
+ターゲット読者: {target_audience}
+テーマ: {theme}
+あらすじ: {synopsis}
+世界観: {world}
+キャラクター（抜粋）:
+{characters}
+
+【評価項目】
+1.  **作品の魅力・独自性**: どれだけ読者の興味を引き、他作品との差別化ができているか。
+2.  **ストーリー展開**: プロットの面白さ、テンポ、伏線、クリフハンガーの適切さ。
+3.  **キャラクターの魅力**: 主人公や主要キャラクターの造形の深さ、共感性、成長性。
+4.  **世界観のリアリティ・魅力**: 設定の緻密さ、想像力、物語との整合性。
+5.  **文章力・表現力**: 読みやすさ、描写の豊かさ、感情表現の巧みさ。
+6.  **ターゲット読者への訴求力**: 設定や展開がターゲット層に響いているか。
+7.  **全体的な完成度・商業性**: ライトノベルとして市場に受け入れられる可能性。
+
+各項目について、5段階評価（★☆☆☆☆ ～ ★★★★★）で評価し、具体的な改善点を提案してください。最も改善が必要な点、そして作品の強みを明確にしてください。
+"""
+
+_IMPROVEMENT_TEMPLATE = """
+あなたはライトノベルの専門家であり、プロの編集者です。以下の作品情報を基に、読者にさらに愛される作品にするための具体的な改善提案を行ってください。
+
+【作品情報】
+ジャンル: {genre}
+ターゲット読者: {target_audience}
+テーマ: {theme}
+あらすじ: {synopsis}
+世界観: {world}
+主要キャラクター（抜粋）:
+{characters}
+
+【改善提案の観点】
+1.  **読者のエンゲージメント向上**: 読者が物語にさらに没入し、キャラクターに感情移入できるよう、どのような要素を加えるべきか。
+2.  **ストーリーのフック強化**: プロットに更なる魅力を加えるためのアイデア（伏線、どんでん返し、葛藤の深化など）。
+3.  **キャラクターアークの深化**: キャラクターに更なる深みや成長を与えるための要素。
+4.  **世界観の活用**: 設定を物語の面白さにどう活かすか、深掘りすべき点。
+5.  **テーマの強調**: 作品のテーマを読者に強く印象付けるための方法。
+6.  **ライトノベルとしての独自性**: 他作品との差別化を図り、読者の記憶に残る作品にするための工夫。
+
+これらの観点に基づき、具体的で実践的な改善策を提案してください。
+"""
+
+# 作品総合診断と改善提案を1回の呼び出しでまとめて生成する（作品情報は共通）
+_QUALITY_PACK_TEMPLATE = """
+あなたは経験豊富なライトノベルの編集者です。以下の作品情報を基に、2つのタスクをまとめて行ってください。
+
+【作品基本情報】
+ジャンル: {genre}
+ターゲット読者: {target_audience}
+テーマ: {theme}
+あらすじ: {synopsis}
+世界観: {world}
+主要キャラクター（抜粋）:
+{characters}
+
+### TASK_A: 診断
+作品の魅力・独自性、ストーリー展開、キャラクターの魅力、世界観のリアリティ・魅力、文章力・表現力、ターゲット読者への訴求力、全体的な完成度・商業性の7項目を、
+それぞれ5段階評価（★☆☆☆☆ ～ ★★★★★）で評価し、具体的な改善点を挙げてください。最も改善が必要な点と作品の強みを明確にしてください。
+
+### TASK_B: 改善提案
+読者のエンゲージメント向上、ストーリーのフック強化、キャラクターアークの深化、世界観の活用、テーマの強調、ライトノベルとしての独自性の6つの観点から、
+具体的で実践的な改善策を提案してください。TASK_A と重複する指摘は簡潔にまとめてください。
+
+出力は次の形式に厳密に従い、区切り以外の前置きや説明は不要です。
+<<DIAG>>
+（TASK_A の結果）
+<<END_DIAG>>
+<<IMPR>>
+（TASK_B の結果）
+<<END_IMPR>>
+"""
+_QUALITY_PACK_SECTION_RE = re.compile(r'<<(DIAG|IMPR)>>(.*?)<<END_\1>>', re.DOTALL)
+_QUALITY_PACK_FIELDS = {"DIAG": "diagnosis_result", "IMPR": "improvement_suggestion"}
+
+# additional_params で指定されなかった場合の既定値
+_TEMPLATE_DEFAULTS = {
+    "chapter": {'chapter_name': '第X章', 'chapter_plot': '指定なし', 'target_length': '3000-5000', 'writing_style': '三人称'},
+    "full_story": {'target_length': '10000-15000', 'chapter_count': '3-5', 'writing_style': '三人称'},
+}
+
+# --- AIコンテンツ生成関数 ---
+
+def _parse_chapter_count(chapter_count: str, default: int = 3, limit: int = 10) -> int:
+    """「3-5章」のような入力から生成する章数を決める（範囲指定は下限を採用）"""
+    match = re.search(r'\d+', str(chapter_count))
+    if not match:
+        return default
+    return max(1, min(int(match.group()), limit))
+
+def _chapter_role(index: int, total: int) -> str:
+    """全体構成における各章の役割を返す"""
+    if total == 1:
+        return "プロローグから事件の発生、クライマックス、エピローグまでを1章で完結させる"
+    if index == 1:
+        return "魅力的なプロローグ、キャラクター紹介と世界観提示"
+    if index == total:
+        return "クライマックスの決着、解決・エピローグ"
+    if index == 2:
+        return "事件・問題の発生"
+    return "展開・クライマックスへの盛り上がり"
+
+_OUTLINE_LINE_RE = re.compile(r'第\s*(\d+)\s*章\s*[:：]?\s*(.+)')
+
+def _parse_outline(outline: str, total: int) -> Dict[int, str]:
+    """章構成の応答から「章番号 -> その章の概要」を取り出す"""
+    chapter_plans = {}
+    for match in _OUTLINE_LINE_RE.finditer(outline):
+        index = int(match.group(1))
+        if 1 <= index <= total and index not in chapter_plans:
+            chapter_plans[index] = match.group(2).strip()
+    return chapter_plans
+
+def generate_ai_content(content_type: str, project_data: dict, additional_params: dict = None) -> str:
+    """AI コンテンツ生成の統一関数"""
+    info = {key: project_data.get(key, '未設定') for key in ('genre', 'target_audience', 'theme', 'synopsis')}
+    world = (project_data.get('world_setting', '') or '未設定')[:500]
+    base_info = _BASE_INFO_TEMPLATE.format(world=world, **info)
+
+    # 未指定の項目はテンプレートごとの既定値、それ以外は空文字で埋める
+    params = collections.defaultdict(str, _TEMPLATE_DEFAULTS.get(content_type, {}))
+    params.update(additional_params or {})
+    params['base_info'] = base_info
+
+    if content_type == "chapter" and project_data.get('characters'):
+        char_list_display = list(project_data['characters'].keys())[:5]
+        params['char_info'] = f"\n主要キャラクター（抜粋）:\n{', '.join(char_list_display)}"
+
+    if content_type == "full_story":
+        chapter_total = _parse_chapter_count(params['chapter_count'])
+        params['chapter_total'] = chapter_total
+
+        # まず短い呼び出しで章構成を決め、各章の執筆はそれを共有して並行実行する
+        outline_response = call_generative_api(_FULL_STORY_OUTLINE_TEMPLATE.format_map(params))
+        if 'error' in outline_response or outline_response['text'].startswith("エラー"):
+            return outline_response['text']
+        outline = outline_response['text'].strip()
+        chapter_plans = _parse_outline(outline, chapter_total)
+
+        chapter_prompts = [
+            _FULL_STORY_CHAPTER_TEMPLATE.format_map(collections.defaultdict(
+                str, params, outline=outline, chapter_index=i,
+                chapter_plan=chapter_plans.get(i, _chapter_role(i, chapter_total))
+            ))
+            for i in range(1, chapter_total + 1)
+        ]
+
+        # 各章を並行生成し、所要時間を「全章の合計」から「最も遅い章」程度に短縮する
+        results = call_generative_api_batch(chapter_prompts)
+        for result in results:
+            if 'error' in result or result['text'].startswith("エラー"):
+                return result['text']
+        return "\n\n".join(f"{result['text'].strip()}\n\n【第{i}章 終了】" for i, result in enumerate(results, start=1))
+
+    prompt = _CONTENT_TEMPLATES[content_type].format_map(params) if content_type in _CONTENT_TEMPLATES else ""
+
+    # 生成中の文章を逐次表示し、応答全体の完了を待たずに書き出しを確認できるようにする
+    # （逐次表示の呼び出しはキャッシュされないため、同じ入力でも毎回新しく生成される）
+    api_response = {}
+    placeholder = st.empty()
+    placeholder.write_stream(call_generative_api_stream(prompt, api_response))
+    placeholder.empty()
     return api_response['text']
 
+def _parse_initial_pack(text: str) -> Dict[str, str]:
+    """一括生成の応答を区切り行で分割し、プロジェクトの項目名ごとにまとめる"""
+    parts = _INITIAL_PACK_SECTION_RE.split(text)
+    # parts は [前置き, 区切り名, 本文, 区切り名, 本文, ...] の形になる
+    return {_INITIAL_PACK_FIELDS[name]: body.strip() for name, body in zip(parts[1::2], parts[2::2]) if body.strip()}
+
+def generate_initial_pack(project_data: dict, tone: str = "おまかせ", custom_elements: str = "", world_elements: str = "") -> Dict[str, str]:
+    """テーマ・あらすじ・世界観を1回のAI呼び出しでまとめて生成する（失敗時は 'error' を含む辞書を返す）"""
+    prompt = _INITIAL_PACK_TEMPLATE.format(
+        genre=project_data.get('genre', '未設定'),
+        target_audience=project_data.get('target_audience', '未設定'),
+        tone=tone,
+        custom_elements=custom_elements or 'なし',
+        world_elements=world_elements or 'なし'
+    )
+    api_response = call_generative_api(prompt)
+    if 'error' in api_response or api_response['text'].startswith("エラー"):
+        return {'error': api_response['text']}
+
+    sections = _parse_initial_pack(api_response['text'])
+    if len(sections) < len(_INITIAL_PACK_FIELDS):
+        return {'error': "エラー: AIの応答からテーマ・あらすじ・世界観を読み取れませんでした。もう一度お試しください。"}
+    return sections
+
+def generate_quality_pack(project: dict) -> Dict[str, str]:
+    """作品総合診断と改善提案を1回のAI呼び出しでまとめて生成する（失敗時は 'error' を含む辞書を返す）"""
+    prompt = _QUALITY_PACK_TEMPLATE.format(**project_prompt_fields(project))
+    api_response = call_generative_api(prompt)
+    if 'error' in api_response or api_response['text'].startswith("エラー"):
+        return {'error': api_response['text']}
+
+    sections = {_QUALITY_PACK_FIELDS[name]: body.strip() for name, body in _QUALITY_PACK_SECTION_RE.findall(api_response['text']) if body.strip()}
+    if len(sections) < len(_QUALITY_PACK_FIELDS):
+        return {'error': "エラー: AIの応答から診断結果と改善提案を読み取れませんでした。もう一度お試しください。"}
+    return sections
+
+@st.cache_data(ttl=300, show_spinner=False)
+def build_context_snippet(world_setting: str, character_roles: tuple) -> Dict[str, str]:
+    """診断・改善提案用に世界観の抜粋とキャラクター一覧のJSONを作る（同じ内容なら再計算しない）"""
+    return {
+        "world": world_setting[:1000],
+        # インデントなしのJSONにして、プロンプトの文字数を減らす
+        "characters": orjson.dumps(dict(character_roles)).decode("utf-8")
+    }
+
+def project_prompt_fields(project: dict) -> Dict[str, str]:
+    """作品総合診断・改善提案テンプレートに埋め込む作品情報"""
+    character_roles = tuple((name, data.get('role')) for name, data in list(project.get('characters', {}).items())[:5])
+    return {
+        "genre": project.get('genre', '未設定'),
+        "target_audience": project.get('target_audience', '未設定'),
+        "theme": project.get('theme', '未設定'),
+        "synopsis": project.get('synopsis', '未設定'),
+        **build_context_snippet(project.get('world_setting', '未設定'), character_roles)
+    }
+
 def modify_content_with_ai(content: str, modification_request: str, content_type: str = "テキスト") -> str:
     """AIを使ってコンテンツを修正する"""
-    modification_prompt = f"""
-以下の{content_type}を、ユーザーの指示に従って修正してください。
+    # 修正前の文章は指示と分けて渡す（予測出力・プロンプトキャッシュに使う）
+    modification_instruction = f"""
+提示された{content_type}を、ユーザーの指示に従って修正してください。
 
 【修正指示】
 {modification_request}
 
-【現在の{content_type}】
-{content}
-
 【修正要求】
 - 修正指示に沿って内容を改善してください。
 - 元のテキストの良い点は維持しつつ、指示された変更を加えてください。
@@ -373,11 +951,13 @@ def modify_content_with_ai(content: str, modification_request: str, content_type
 
 修正された{content_type}のみを出力してください。余計な説明は不要です。
 """
-    api_response = call_generative_api(modification_prompt)
+    api_response = call_generative_api_revision(modification_instruction, content, content_type)
     return api_response['text']
 
 # --- 認証処理（初回ユーザー設定） ---
 
+BCRYPT_MAX_PASSWORD_BYTES = 72 # bcrypt がハッシュ化できるパスワードの最大長
+
 # save_user_data() 関数の定義を追加
 def save_user_data():
     """ユーザーデータをsession_stateに保存（永続化はしない簡易版）"""
@@ -390,16 +970,26 @@ def load_user_data(username):
     # 今回は簡易的なため、セッションステートには特に何もロードしません。
     pass
 
+def hash_password(password: str) -> bytes:
+    """パスワードを bcrypt でハッシュ化（登録時に一度だけ実行）"""
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+
+def verify_password(password: str, password_hash: Optional[bytes]) -> bool:
+    """入力されたパスワードを登録済みのハッシュと照合"""
+    if not password_hash:
+        return False
+    try:
+        return bcrypt.checkpw(password.encode("utf-8"), password_hash)
+    except ValueError: # bcrypt が扱えない長さのパスワード
+        return False
+
 def authenticate_user(username, password):
     """ユーザー名とパスワードの認証を行う"""
-    # 簡易認証：初回登録時に設定されたユーザー名とパスワードを検証
+    # 簡易認証：初回登録時に設定されたユーザー名とパスワードのハッシュを検証
     if username == st.session_state.get('registered_username') and \
-       password == st.session_state.get('registered_password'):
+       verify_password(password, st.session_state.get('registered_password_hash')):
         st.session_state.current_user = username
         st.session_state.logged_in = True
-        # ユーザー固有のAPIキーをロード（または初期化）
-        if username not in st.session_state.user_api_keys:
-            st.session_state.user_api_keys[username] = {}
         load_user_data(username) # ここで永続化されたデータをロードする想定
         return True
     return False
@@ -425,18 +1015,20 @@ def setup_user_view():
         
         if submitted:
             if new_username and new_password and confirm_password:
-                if new_password == confirm_password:
+                if new_password != confirm_password:
+                    st.error("パスワードが一致しません。")
+                elif len(new_password.encode("utf-8")) > BCRYPT_MAX_PASSWORD_BYTES:
+                    st.error(f"パスワードは{BCRYPT_MAX_PASSWORD_BYTES}バイト以内で設定してください。")
+                else:
                     # ここでユーザー名を検証・保存する（今回は簡易的にsession_stateに）
+                    # パスワードは平文では保持せず、ハッシュのみを保存する
                     st.session_state.registered_username = new_username
-                    st.session_state.registered_password = new_password
+                    st.session_state.registered_password_hash = hash_password(new_password)
                     st.session_state.current_user = new_username
                     st.session_state.logged_in = True
-                    st.session_state.user_api_keys[new_username] = {} # 新しいユーザーのAPIキー用辞書を初期化
                     save_user_data() # 永続化処理 (今回は何もしない)
                     st.success(f"アカウント「{new_username}」が作成されました！")
                     st.rerun()
-                else:
-                    st.error("パスワードが一致しません。")
             else:
                 st.error("ユーザー名とパスワードを両方入力してください。")
         st.markdown('</div>', unsafe_allow_html=True)
@@ -476,15 +1068,12 @@ if 'current_user' not in st.session_state:
     st.session_state.current_user = None
 if 'registered_username' not in st.session_state: # 登録済みのユーザー名を保持
     st.session_state.registered_username = None
-if 'registered_password' not in st.session_state: # 登録済みパスワードを保持
-    st.session_state.registered_password = None
+if 'registered_password_hash' not in st.session_state: # 登録済みパスワードのハッシュを保持
+    st.session_state.registered_password_hash = None
 if 'projects' not in st.session_state:
     st.session_state.projects = {}
 if 'current_project' not in st.session_state:
     st.session_state.current_project = None
-# APIキーはユーザーごとに管理
-if 'user_api_keys' not in st.session_state:
-    st.session_state.user_api_keys = {} # { 'username': {'gemini': '...', 'openai': '...'}, ... }
 if 'selected_model_provider' not in st.session_state:
     st.session_state.selected_model_provider = "Gemini"
 if 'api_usage' not in st.session_state:
@@ -492,16 +1081,22 @@ if 'api_usage' not in st.session_state:
         'daily_requests': 0, 'daily_tokens_used': 0,
         'last_reset_date': datetime.now().date().isoformat(),
         'total_requests': 0, 'total_tokens_used': 0,
-        'request_history': []
+        'request_history': collections.deque(maxlen=100) # 直近100件のみ保持
     }
 if 'current_call_token_info' not in st.session_state:
     st.session_state.current_call_token_info = {}
 
-# プロジェクトデータ構造に glossary を追加
-if 'projects' in st.session_state:
-    for project_name, project_data in st.session_state.projects.items():
-        if 'glossary' not in project_data:
-            project_data['glossary'] = {}
+# プロジェクトデータ構造に glossary を追加（セッションごとに一度だけ実行）
+if not st.session_state.get('_glossary_migrated'):
+    for project_data in st.session_state.projects.values():
+        project_data.setdefault('glossary', {})
+    st.session_state._glossary_migrated = True
+
+# 章データを一覧用のメタ情報と本文に分けた構造へ移行（セッションごとに一度だけ実行）
+if not st.session_state.get('_chapters_migrated'):
+    for project_data in st.session_state.projects.values():
+        migrate_chapters(project_data)
+    st.session_state._chapters_migrated = True
 
 # 日付リセット
 current_date = datetime.now().date().isoformat()
@@ -535,7 +1130,8 @@ def glossary_sidebar_view():
                 if new_term_name not in glossary:
                     glossary[new_term_name] = {
                         'description': new_term_description,
-                        'added_at': datetime.now().isoformat()
+                        'added_at': datetime.now().isoformat(),
+                        '_lc': new_term_name.lower() # 検索用に小文字化した用語名を保持
                     }
                     st.sidebar.success(f"「{new_term_name}」を用語集に追加しました。")
                     st.rerun()
@@ -552,7 +1148,12 @@ def glossary_sidebar_view():
     else:
         search_term = st.sidebar.text_input("用語を検索", key="glossary_search_input", placeholder="例：アルカナライト")
         
-        filtered_glossary_keys = [term for term in glossary if search_term.lower() in term.lower()]
+        # 登録時に小文字化しておいた用語名で照合する（古いデータは '_lc' がないためその場で小文字化）
+        needle = search_term.lower()
+        filtered_glossary_keys = [
+            term for term, term_data in glossary.items()
+            if needle in (term_data['_lc'] if '_lc' in term_data else term.lower())
+        ] if needle else list(glossary)
         
         if not filtered_glossary_keys:
             st.sidebar.warning("該当する用語は見つかりませんでした。")
@@ -595,7 +1196,8 @@ def glossary_sidebar_view():
                                 
                                 glossary[edited_term_name] = {
                                     'description': edited_term_description,
-                                    'added_at': term_data_orig.get('added_at', datetime.now().isoformat())
+                                    'added_at': term_data_orig.get('added_at', datetime.now().isoformat()),
+                                    '_lc': edited_term_name.lower()
                                 }
                                 del st.session_state.editing_glossary_term
                                 st.success(f"用語「{edited_term_name}」を更新しました。")
@@ -607,7 +1209,552 @@ def glossary_sidebar_view():
                         del st.session_state.editing_glossary_term
                         st.rerun()
 
+# --- AI企画生成の選択肢 ---
+GENRE_MAP = {"異世界": "異世界ファンタジー", "学園": "学園もの", "SF": "SF", "恋愛": "恋愛", "バトル": "バトル・アクション", "ファンタジー": "現代ファンタジー", "ミステリー": "ミステリー", "おまかせ": "異世界ファンタジー"}
+TARGET_MAP = {"男性向け": "中高生男性", "女性向け": "中高生女性", "全年齢": "全年齢", "おまかせ": "中高生男性"}
+
+# --- 選択肢の定義 ---
+GENRES = ("異世界ファンタジー", "現代ファンタジー", "学園もの", "SF", "ミステリー", "恋愛", "バトル・アクション", "日常系", "ホラー・サスペンス", "その他")
+TARGET_AUDIENCES = ("中高生男性", "中高生女性", "大学生・20代男性", "大学生・20代女性", "30代以上", "全年齢", "特定ターゲット")
+ROLES = ("主人公", "ヒロイン", "ライバル", "親友", "師匠", "敵役", "サポート", "その他")
+ROLE_IDX = {role: i for i, role in enumerate(ROLES)}
+
+# --- 執筆モード定義 ---
+WRITING_MODES = ["manual", "ai", "hybrid"]
+WRITING_MODE_LABELS = {"manual": "🖊️ セルフ執筆", "ai": "🤖 AI執筆支援", "hybrid": "🔄 ハイブリッド"}
+WRITING_MODE_HELP = {
+    "manual": "自分で執筆します。AIはアイデア出しや推敲に使います。",
+    "ai": "AIに生成してもらい、それを基にあなたの創作を広げます。",
+    "hybrid": "手動とAI生成を組み合わせて効率的に進めます。"
+}
+
+# --- キャラクター一覧の表示列（列名: 表示名） ---
+CHARACTER_COLUMNS = {
+    "role": "役割", "details": "詳細設定", "personality": "性格",
+    "background": "背景", "appearance": "外見", "speech": "口調"
+}
+
 # --- メインコンテンツ表示関数 ---
+def is_api_key_set() -> bool:
+    """選択中のAIプロバイダーのAPIキーが現在のユーザーに設定されているか"""
+    return bool(get_api_key(st.session_state.selected_model_provider))
+
+def require_api_key(fn):
+    """AI機能を使う操作の前に、選択中のプロバイダーのAPIキーを確認する（未設定ならエラーを表示して None を返す）"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not is_api_key_set():
+            st.error(f"AI機能を利用するには、サイドバーで{st.session_state.selected_model_provider}のAPIキーを設定してください。")
+            return None
+        return fn(*args, **kwargs)
+    return wrapper
+
+def _rerun_tab():
+    """操作したタブだけを再実行（アプリ全体の実行中に呼ばれた場合は全体を再実行）"""
+    try:
+        st.rerun(scope="fragment")
+    except st.errors.StreamlitAPIException:
+        st.rerun()
+
+@st.dialog("キャラクター編集", width="large")
+def _edit_character_dialog(char_to_edit: str, project: dict):
+    """キャラクターの詳細を編集するダイアログ"""
+    char_data_orig = project['characters'][char_to_edit]
+    edited_char_name = st.text_input("キャラクター名", value=char_to_edit, key=f"edit_name_{char_to_edit}")
+    edited_char_role = st.selectbox("役割", ROLES, index=ROLE_IDX.get(char_data_orig.get('role'), len(ROLES) - 1), key=f"edit_role_{char_to_edit}")
+    edited_char_details = st.text_area("詳細設定", value=char_data_orig.get('details', ''), key=f"edit_details_{char_to_edit}", height=300)
+
+    if st.button("変更を保存", key=f"save_char_{char_to_edit}"):
+        if edited_char_name not in project['characters'] or edited_char_name == char_to_edit:
+            project['characters'][edited_char_name] = {
+                'role': edited_char_role,
+                'details': edited_char_details
+            }
+            if edited_char_name != char_to_edit:
+                del project['characters'][char_to_edit]
+            st.rerun()
+        else:
+            st.warning(f"キャラクター「{edited_char_name}」は既に存在します。")
+
+    if st.button("キャンセル", key=f"cancel_char_{char_to_edit}"):
+        st.rerun()
+
+@st.dialog("章の編集", width="large")
+def _edit_chapter_dialog(chapter_name_to_edit: str, project: dict):
+    """章の内容を編集するダイアログ"""
+    text_key = f"edit_chapter_text_{chapter_name_to_edit}"
+    # AIの修正案は入力欄を作る前に反映する（作成後は値を書き換えられないため）
+    ai_modified_key = f"{text_key}_ai_modified"
+    if ai_modified_key in st.session_state:
+        st.session_state[text_key] = st.session_state.pop(ai_modified_key)
+    # 初期値も session_state から与える（value= と併用すると Streamlit が警告を出す）
+    st.session_state.setdefault(text_key, project['chapters_body'][chapter_name_to_edit])
+
+    st.write(f"**{chapter_name_to_edit}**")
+    edited_chapter_content = st.text_area("編集内容", height=400, key=text_key)
+    
+    modification_instruction = st.text_area("AIによる修正指示（任意）", placeholder="例：この部分をもっと詳しく描写してほしい、セリフを変更してほしい...", height=80, key=f"edit_chapter_instruction_{chapter_name_to_edit}")
+    
+    col_edit_save, col_edit_cancel, col_edit_ai_modify = st.columns(3)
+    
+    with col_edit_save:
+        if st.button("変更を保存", key=f"save_chapter_edit_{chapter_name_to_edit}"):
+            save_chapter(project, chapter_name_to_edit, edited_chapter_content)
+            st.session_state.pop(text_key, None)
+            st.rerun()
+    with col_edit_cancel:
+        if st.button("キャンセル", key=f"cancel_chapter_edit_{chapter_name_to_edit}"):
+            st.session_state.pop(text_key, None)
+            st.rerun()
+    with col_edit_ai_modify:
+        if st.button("🤖 AIで修正", key=f"ai_modify_chapter_{chapter_name_to_edit}") and modification_instruction:
+            _modify_chapter(edited_chapter_content, modification_instruction, ai_modified_key)
+
+# --- AI操作（ボタンが押されたときだけ呼び出す） ---
+STREAM_UPDATE_EVERY = 8 # 診断・改善提案のストリーミング表示を更新するチャンク間隔
+
+@require_api_key
+def _modify_chapter(content: str, instruction: str, ai_modified_key: str):
+    with st.spinner("AIで修正中..."):
+        modified_content = modify_content_with_ai(content, instruction, "章の内容")
+        if not modified_content.startswith("エラー"):
+            st.session_state[ai_modified_key] = modified_content
+            # ダイアログだけを再実行し、修正案を入力欄に表示する
+            st.rerun(scope="fragment")
+        else:
+            st.error(modified_content)
+
+@require_api_key
+def _generate_theme(project: dict, genre_preference: str, target_preference: str, tone_preference: str):
+    with st.spinner("企画生成中..."):
+        project['genre'] = GENRE_MAP.get(genre_preference, "その他")
+        project['target_audience'] = TARGET_MAP.get(target_preference, "特定ターゲット")
+        
+        theme_prompt = f"ジャンル「{project['genre']}」、読者層「{project['target_audience']}」、雰囲気「{tone_preference}」の物語に適した、ライトノベルの読者が興味を惹かれるような魅力的なテーマを1つ、15文字以内で簡潔に提案してください。"
+        
+        api_response = call_generative_api(theme_prompt)
+        if 'error' not in api_response and not api_response['text'].startswith("エラー"):
+            project['theme'] = api_response['text'].strip()
+            st.toast("企画を自動生成しました！")
+            _rerun_tab()
+        else:
+            st.error(api_response['text'])
+            project['theme'] = "成長と友情の物語"
+
+@require_api_key
+def _generate_initial_settings(project: dict, genre_preference: str, target_preference: str, tone_preference: str):
+    with st.spinner("テーマ・あらすじ・世界観を一括生成中..."):
+        project['genre'] = GENRE_MAP.get(genre_preference, "その他")
+        project['target_audience'] = TARGET_MAP.get(target_preference, "特定ターゲット")
+        # あらすじ・世界観の追加要望は各タブの入力欄の値を使う
+        initial_pack = generate_initial_pack(
+            project, tone_preference,
+            st.session_state.get("synopsis_custom_elements", ""),
+            st.session_state.get("world_elements_input", "")
+        )
+        if 'error' not in initial_pack:
+            project.update(initial_pack)
+            st.toast("テーマ・あらすじ・世界観を一括生成しました！")
+            # 世界観タブにも反映させるため、アプリ全体を再実行する
+            st.rerun(scope="app")
+        else:
+            st.error(initial_pack['error'])
+
+@require_api_key
+def _generate_field(project: dict, field: str, content_type: str, additional_params: dict, spinner_text: str, done_message: str):
+    """あらすじ・世界観などを生成して project[field] に保存する"""
+    with st.spinner(spinner_text):
+        generated = generate_ai_content(content_type, project, additional_params)
+        if not generated.startswith("エラー"):
+            project[field] = generated
+            st.toast(done_message)
+            _rerun_tab()
+        else:
+            st.error(generated)
+
+@require_api_key
+def _propose_modification(content: str, instruction: str, content_type: str, proposal_key: str):
+    """AIの修正案を作り、採用されるまで st.session_state[proposal_key] に保持する"""
+    with st.spinner("修正中..."):
+        modified = modify_content_with_ai(content, instruction, content_type)
+        if not modified.startswith("エラー"):
+            st.session_state[proposal_key] = modified
+            st.toast("修正案が作成されました。内容を確認し、採用ボタンを押してください。")
+        else:
+            st.error(modified)
+
+@require_api_key
+def _generate_character_details(char_name: str, char_role: str, char_details: str) -> str:
+    with st.spinner("キャラクター生成中..."):
+        full_char_prompt = _CHARACTER_DETAIL_TEMPLATE.format(char_name=char_name, char_role=char_role, char_details=char_details)
+        api_response = call_generative_api(full_char_prompt)
+        if 'error' not in api_response and not api_response['text'].startswith("エラー"):
+            st.success(f"キャラクター「{char_name}」をAIで生成しました！")
+            return api_response['text']
+        st.error(api_response['text'])
+        return "AI生成に失敗しました。"
+
+@require_api_key
+def _write_chapter(project: dict, chapter_name: str, plot_outline: str, target_length: str, writing_style: str):
+    with st.spinner("執筆中..."):
+        chapter_content = generate_ai_content("chapter", project, {
+            "chapter_name": chapter_name,
+            "chapter_plot": plot_outline,
+            "target_length": target_length,
+            "writing_style": writing_style
+        })
+        if not chapter_content.startswith("エラー"):
+            save_chapter(project, chapter_name, chapter_content)
+            st.toast(f"「{chapter_name}」の執筆が完了しました！")
+        else:
+            st.error(chapter_content)
+
+@require_api_key
+def _generate_full_story(project: dict, total_length: str, chapter_count: str, full_writing_style: str):
+    with st.spinner("作品全体を生成中... 少々お待ちください。"):
+        full_story_content = generate_ai_content("full_story", project, {
+            "target_length": total_length,
+            "chapter_count": chapter_count,
+            "writing_style": full_writing_style
+        })
+        if not full_story_content.startswith("エラー"):
+            project['chapters_meta'], project['chapters_body'] = [], {}
+            save_chapter(project, "全体生成結果", full_story_content)
+            project['full_story_length'] = total_length
+            project['full_story_chapters'] = chapter_count
+            project['full_story_style'] = full_writing_style
+            
+            st.toast("作品全体の生成が完了しました！「執筆済み章一覧」で確認できます。")
+        else:
+            st.error(full_story_content)
+
+@require_api_key
+def _stream_report(project: dict, template: str, result_key: str, title: str, spinner_text: str, done_message: str) -> bool:
+    """作品総合診断・改善提案を生成しながら表示し、完了したら st.session_state[result_key] に保存する"""
+    with st.spinner(spinner_text):
+        prompt = template.format(**project_prompt_fields(project))
+        # 生成中の結果をそのまま表示する（完了後の再実行は不要）
+        st.subheader(title)
+        api_response = {}
+        output = st.empty()
+        previous_result = st.session_state.get(result_key)
+        chunks = []
+        for chunk in call_generative_api_stream(prompt, api_response):
+            chunks.append(chunk)
+            # 描画と保存は8チャンクごとにまとめる（途中で別の操作をしても、そこまでの結果は残る）
+            if len(chunks) % STREAM_UPDATE_EVERY == 0:
+                partial_text = "".join(chunks)
+                output.markdown(partial_text)
+                st.session_state[result_key] = partial_text
+        if 'error' not in api_response and not api_response['text'].startswith("エラー"):
+            output.markdown(api_response['text'])
+            st.session_state[result_key] = api_response['text']
+            st.success(done_message)
+            return True
+        # 失敗した場合は途中までの結果を破棄し、前回の結果に戻す
+        if previous_result is None:
+            st.session_state.pop(result_key, None)
+        else:
+            st.session_state[result_key] = previous_result
+        output.empty()
+        st.error(api_response['text'])
+        return False
+
+@require_api_key
+def _generate_quality_pack(project: dict):
+    with st.spinner("総合診断と改善提案をまとめて生成中..."):
+        quality_pack = generate_quality_pack(project)
+        if 'error' not in quality_pack:
+            st.session_state.update(quality_pack)
+            st.toast("作品総合診断と改善提案を同時に生成しました！")
+            # 分析・改善タブにも反映させるため、アプリ全体を再実行する
+            st.rerun(scope="app")
+        else:
+            st.error(quality_pack['error'])
+
+def _sync_synopsis_score(project: dict):
+    """あらすじがAI生成・修正案の採用・作品切り替えで変わっていたら、入力欄と品質スコアを更新する"""
+    if st.session_state.get('synopsis_input') != project.get('synopsis', ''):
+        st.session_state.synopsis_input = project.get('synopsis', '')
+        st.session_state.synopsis_score = analyze_synopsis_quality(st.session_state.synopsis_input)
+
+def _on_synopsis_change(project: dict):
+    """あらすじ入力欄の確定時（フォーカスが外れた時）だけ品質スコアを計算し直す"""
+    project['synopsis'] = st.session_state.synopsis_input
+    st.session_state.synopsis_score = analyze_synopsis_quality(project['synopsis'])
+
+def _adopt_modification(project: dict, field: str, proposal_key: str):
+    """AIの修正案を採用する（ボタンのコールバックで実行し、同じ実行内で入力欄に反映させる）"""
+    project[field] = st.session_state.pop(proposal_key)
+    # コールバック内では要素を描画できないため、通知はタブの描画時に表示する
+    st.session_state.modification_adopted = True
+
+def _toast_adopted_modification():
+    """修正版の採用直後であれば通知を表示する（1回だけ）"""
+    if st.session_state.pop('modification_adopted', False):
+        st.toast("修正版を採用しました！")
+
+@st.fragment
+def _render_tab_plan(project: dict, writing_mode: str):
+    """企画・設定タブを描画（操作時はこのタブだけを再実行する）"""
+    _toast_adopted_modification()
+    st.header("📋 作品企画・基本設定")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.subheader("基本情報")
+        if writing_mode == 'manual' or writing_mode == 'hybrid':
+            genre_index = GENRES.index(project.get('genre', '')) if project.get('genre') in GENRES else 0
+            project['genre'] = st.selectbox("ジャンル（メイン）", GENRES, index=genre_index)
+            
+            target_index = TARGET_AUDIENCES.index(project.get('target_audience', '')) if project.get('target_audience') in TARGET_AUDIENCES else 0
+            project['target_audience'] = st.selectbox("ターゲット読者層", TARGET_AUDIENCES, index=target_index)
+
+            project['theme'] = st.text_input("作品テーマ（核となるメッセージ）", value=project.get('theme', ''), placeholder="例：友情の大切さ、成長と自立、愛と犠牲...")
+
+        if writing_mode == 'ai' or writing_mode == 'hybrid':
+            st.subheader("🤖 AI自動生成設定")
+            genre_preference = st.selectbox("好みのジャンル", ["おまかせ", "異世界", "学園", "SF", "恋愛", "バトル", "ファンタジー", "ミステリー"], key="ai_genre_pref")
+            target_preference = st.selectbox("ターゲット読者", ["おまかせ", "男性向け", "女性向け", "全年齢"], key="ai_target_pref")
+            tone_preference = st.selectbox("作品の雰囲気", ["おまかせ", "明るい", "シリアス", "コメディ", "ダーク", "感動的", "サスペンスフル"], key="ai_tone_pref")
+            
+            if st.button("🎯 AI企画生成"):
+                _generate_theme(project, genre_preference, target_preference, tone_preference)
+
+            if st.button("🧩 一括初期設定生成", help="テーマ・あらすじ・世界観を1回のAI呼び出しでまとめて生成します。"):
+                _generate_initial_settings(project, genre_preference, target_preference, tone_preference)
+                    
+    with col2:
+        st.subheader("あらすじ・コンセプト")
+        _sync_synopsis_score(project)
+        if writing_mode == 'manual' or writing_mode == 'hybrid':
+            st.text_area("作品あらすじ（200-400文字）", key="synopsis_input", on_change=_on_synopsis_change, args=(project,), height=150, help="読者が最初に見る重要な要素。魅力的で続きが気になる内容に")
+
+        if writing_mode == 'ai' or writing_mode == 'hybrid':
+            st.subheader("🤖 AI あらすじ生成")
+            custom_elements = st.text_area("追加要望（オプション）", placeholder="例：主人公は料理が得意、ドラゴンが登場、切ないラブコメ要素...", height=80, key="synopsis_custom_elements")
+            if st.button("✨ AIあらすじ生成", key="generate_synopsis_btn"):
+                _generate_field(project, 'synopsis', "synopsis", {"custom_elements": custom_elements}, "あらすじ生成中...", "あらすじを生成しました！")
+
+        if project.get('synopsis'):
+            with st.expander("🔧 あらすじ修正 (AI)"):
+                synopsis_modification = st.text_area("修正指示", placeholder="例：もっと感動的に、謎めいた要素を追加、主人公の心情を丁寧に...", height=60, key="synopsis_mod")
+                if st.button("🤖 あらすじを修正", key="modify_synopsis_btn") and synopsis_modification:
+                    _propose_modification(project['synopsis'], synopsis_modification, "あらすじ", 'modified_synopsis')
+            
+            if 'modified_synopsis' in st.session_state and st.session_state.modified_synopsis:
+                st.write("#### 修正案の確認")
+                col_rev1, col_rev2 = st.columns(2)
+                with col_rev1:
+                    st.write("**修正前**"); st.write(project['synopsis'])
+                with col_rev2:
+                    st.write("**修正後**"); st.write(st.session_state.modified_synopsis)
+                
+                st.button("✅ 修正版を採用", key="accept_synopsis_mod", on_click=_adopt_modification, args=(project, 'synopsis', 'modified_synopsis'))
+
+            # スコアは入力確定時に計算済みの値を使う（再実行のたびに計算しない）
+            synopsis_score = st.session_state.synopsis_score
+            if synopsis_score >= 80: st.markdown('<div class="quality-indicator quality-high">✅ あらすじ品質: 高</div>', unsafe_allow_html=True)
+            elif synopsis_score >= 60: st.markdown('<div class="quality-indicator quality-medium">⚠️ あらすじ品質: 中（改善推奨）</div>', unsafe_allow_html=True)
+            else: st.markdown('<div class="quality-indicator quality-low">❌ あらすじ品質: 低（要改善）</div>', unsafe_allow_html=True)
+
+@st.fragment
+def _render_tab_characters(project: dict):
+    """キャラクタータブを描画（操作時はこのタブだけを再実行する）"""
+    st.header("👥 キャラクター設定")
+    st.subheader("既存キャラクター")
+    # 一覧は追加処理の後に描画し、追加したキャラクターを再実行なしで表示する
+    character_list = st.container()
+
+    st.subheader("新キャラクター作成")
+    # 作成方法で入力欄が変わるため、方法の選択だけはフォームの外に置く
+    char_creation_mode = st.radio("作成方法", ["✋ 手動", "🤖 AI"], key="char_creation_mode_radio", horizontal=True)
+
+    # 入力のたびに再実行せず、追加ボタンを押したときにまとめて送信する
+    with st.form("new_character_form"):
+        col_char_name, col_char_role = st.columns(2)
+        with col_char_name: new_char_name = st.text_input("キャラクター名", key="new_char_name_input")
+        with col_char_role: new_char_role = st.selectbox("役割", ROLES, key="new_char_role_select")
+
+        char_details_input = ""
+        if char_creation_mode == "🤖 AI":
+            char_details_input = st.text_area("キャラクター詳細要望（AI生成用）", placeholder="例：クールで無口、実は情深い、剣術が得意、過去に因縁あり...", height=80, key="char_ai_details")
+        add_character_submitted = st.form_submit_button("➕ キャラクターを追加")
+
+    if add_character_submitted:
+        if new_char_name and (char_creation_mode == "✋ 手動" or char_details_input):
+            if new_char_name not in project['characters']:
+                char_data = {'role': new_char_role}
+                if char_creation_mode == "✋ 手動":
+                    char_data['details'] = "手動入力用の詳細欄を追加してください。"
+                elif char_creation_mode == "🤖 AI":
+                    char_data['details'] = _generate_character_details(new_char_name, new_char_role, char_details_input)
+                
+                # APIキー未設定で生成できなかった場合は追加しない
+                if char_data.get('details') is not None:
+                    project['characters'][new_char_name] = char_data
+                    st.toast(f"キャラクター「{new_char_name}」を追加しました。")
+            else:
+                st.warning(f"キャラクター「{new_char_name}」は既に存在します。")
+        else:
+            st.warning("キャラクター名と、手動入力またはAI生成のための情報が必要です。")
+
+    with character_list:
+        if not project.get('characters'):
+            st.info("まだキャラクターは登録されていません。")
+        else:
+            # キャラクターごとに展開パネルを作らず、一覧表1つにまとめて描画する
+            characters_df = _get_pandas().DataFrame.from_dict(project['characters'], orient='index').reindex(columns=list(CHARACTER_COLUMNS))
+            characters_event = st.dataframe(
+                characters_df,
+                column_config={column: st.column_config.TextColumn(label, width="large" if column == 'details' else "small") for column, label in CHARACTER_COLUMNS.items()},
+                on_select="rerun",
+                selection_mode="single-row",
+                # 選択状態は作品ごとに保持する（別の作品の行番号を引き継がない）
+                key=f"character_table_{st.session_state.current_project}"
+            )
+            selected_rows = characters_event.selection.rows
+            # キャラクターの削除などで範囲外になった選択は無視する
+            if selected_rows and selected_rows[0] < len(characters_df):
+                name = characters_df.index[selected_rows[0]]
+                if st.button(f"{name} の詳細をAIで編集", key="edit_selected_char"):
+                    _edit_character_dialog(name, project)
+            else:
+                st.caption("行を選択すると、そのキャラクターを編集できます。")
+
+@st.fragment
+def _render_tab_world(project: dict, writing_mode: str):
+    """世界観タブを描画（操作時はこのタブだけを再実行する）"""
+    _toast_adopted_modification()
+    st.header("🗺️ 世界観設定")
+    if writing_mode == 'manual' or writing_mode == 'hybrid':
+        st.subheader("基本世界観設定")
+        project['world_setting'] = st.text_area("世界観の詳細", value=project.get('world_setting', ''), height=300, help="物語の舞台となる世界の背景、ルール、特徴などを記述します。")
+
+    if writing_mode == 'ai' or writing_mode == 'hybrid':
+        st.subheader("🤖 AI 世界観生成")
+        world_elements = st.text_area("世界観に追加したい要素（任意）", placeholder="例：魔法体系、国家間の関係、主要な産業...", height=80, key="world_elements_input")
+        if st.button("🌍 AI世界観生成", key="generate_world_btn"):
+            _generate_field(project, 'world_setting', "world_setting", {"world_elements": world_elements}, "世界観生成中...", "世界観を生成しました！")
+
+    if project.get('world_setting'):
+        with st.expander("🔧 世界観の推敲・修正 (AI)"):
+            world_modification = st.text_area("修正指示", placeholder="例：ファンタジー要素を強く、科学技術レベルを詳細に...", height=60, key="world_mod")
+            if st.button("🤖 世界観を修正", key="modify_world_btn") and world_modification:
+                _propose_modification(project['world_setting'], world_modification, "世界観", 'modified_world')
+        
+        if 'modified_world' in st.session_state and st.session_state.modified_world:
+            st.write("#### 修正案の確認")
+            col_world_rev1, col_world_rev2 = st.columns(2)
+            with col_world_rev1:
+                st.write("**修正前**"); st.write(project['world_setting'])
+            with col_world_rev2:
+                st.write("**修正後**"); st.write(st.session_state.modified_world)
+            
+            st.button("✅ 修正版を採用", key="accept_world_mod", on_click=_adopt_modification, args=(project, 'world_setting', 'modified_world'))
+
+@st.fragment
+def _render_tab_writing(project: dict):
+    """執筆タブを描画（操作時はこのタブだけを再実行する）"""
+    st.header("📖 執筆・原稿管理")
+    
+    execution_mode = st.radio("執筆方法を選択してください", ["📝 章ごと執筆", "📚 作品全体をAIで生成"], key="writing_tab_mode", horizontal=True)
+
+    if execution_mode == "📝 章ごと執筆":
+        st.subheader("章ごとの執筆")
+        # 入力のたびに再実行せず、執筆ボタンを押したときにまとめて送信する
+        with st.form("chapter_form"):
+            chapter_name = st.text_input("章のタイトル / 番号", value=project.get('current_chapter_name', ''))
+            plot_outline = st.text_area("この章のプロット概要", value=project.get('current_chapter_plot', ''), height=100)
+            target_length = st.text_input("目標文字数", value=project.get('current_chapter_length', '3000-5000字'))
+            writing_style = st.selectbox("文体", ["三人称", "一人称"], index=0 if project.get('current_chapter_style', '三人称') == '三人称' else 1)
+            write_chapter_submitted = st.form_submit_button("✍️ この章を執筆")
+
+        if write_chapter_submitted:
+            if not chapter_name or not plot_outline:
+                st.warning("章のタイトルとプロット概要を入力してください。")
+            else:
+                project['current_chapter_name'] = chapter_name
+                project['current_chapter_plot'] = plot_outline
+                project['current_chapter_length'] = target_length
+                project['current_chapter_style'] = writing_style
+
+                _write_chapter(project, chapter_name, plot_outline, target_length, writing_style)
+        
+        st.subheader("執筆済み章一覧")
+        if not project['chapters_meta']:
+            st.info("まだ章は執筆されていません。")
+        else:
+            # 一覧はメタ情報だけで描画し、本文は表示を選んだ章のものだけをブラウザに送る
+            for chapter_meta in project['chapters_meta']:
+                chap_name = chapter_meta['name']
+                with st.expander(f"📖 {chap_name}（{chapter_meta['length']:,}字）"):
+                    if st.toggle("本文を表示", key=f"show_chapter_{chap_name}"):
+                        # 読むだけの表示は入力欄にせず、編集はダイアログでのみ行う
+                        st.container(height=200).markdown(project['chapters_body'][chap_name])
+                    if st.button(f"{chap_name} をAIで修正・追記", key=f"edit_chapter_{chap_name}"):
+                        _edit_chapter_dialog(chap_name, project)
+
+    elif execution_mode == "📚 作品全体をAIで生成":
+        st.subheader("📚 作品全体をAIで生成")
+        with st.form("full_story_form"):
+            total_length = st.text_input("希望する総文字数", value=project.get('full_story_length', '10000-15000字'))
+            chapter_count = st.text_input("希望する章数", value=project.get('full_story_chapters', '3-5章'))
+            full_writing_style = st.selectbox("文体", ["三人称", "一人称"], index=0 if project.get('full_story_style', '三人称') == '三人称' else 1, key="full_story_style_select")
+            full_story_submitted = st.form_submit_button("🎭 作品全体を生成", type="primary")
+
+        if full_story_submitted:
+            _generate_full_story(project, total_length, chapter_count, full_writing_style)
+
+@st.fragment
+def _render_tab_quality(project: dict):
+    """品質チェックタブを描画（操作時はこのタブだけを再実行する）"""
+    st.header("🔍 品質チェック・診断")
+    st.subheader("作品の総合診断")
+    diagnosis_streamed = False
+    if st.button("📊 作品総合診断を実行", key="run_diagnosis_btn"):
+        diagnosis_streamed = bool(_stream_report(project, _DIAGNOSIS_TEMPLATE, 'diagnosis_result', "診断結果", "総合診断中...", "作品総合診断が完了しました。"))
+    if st.button("📊💡 診断＋改善を同時生成", key="run_quality_pack_btn", help="総合診断と改善提案を1回のAI呼び出しでまとめて生成します（改善提案は「分析・改善」タブに表示されます）。"):
+        _generate_quality_pack(project)
+    
+    if 'diagnosis_result' in st.session_state and not diagnosis_streamed:
+        st.subheader("診断結果")
+        st.markdown(st.session_state.diagnosis_result)
+
+    st.markdown("---")
+    st.subheader("ライトノベル要素チェックリスト")
+    st.markdown("""
+    ### 🎯 魅力的な作品のためのチェックリスト
+    **基本要件**
+    - ✅ 十分な文字数（例: 50,000文字以上）
+    - ✅ 魅力的なキャラクター設定（主人公に共感できるか）
+    - ✅ 読者を引き込む書き出し（冒頭数ページで興味を引くか）
+    - ✅ 一貫性のある世界観と設定（矛盾がないか）
+    - ✅ 読者層に響くテーマやメッセージ（ターゲットに刺さるか）
+    
+    **品質要件**
+    - ✅ 完成度の高い文章力（読みやすいか、誤字脱字はないか）
+    - ✅ 魅力的な描写力（情景、感情、心理描写など）
+    - ✅ ストーリー展開のテンポ（飽きさせないか、盛り上がりがあるか）
+    - ✅ キャラクターの魅力と成長（魅力的で、物語を通して変化するか）
+    - ✅ 世界観の独自性・面白さ（魅力的で、物語に深みを与えているか）
+    - ✅ テーマの掘り下げ（テーマが物語全体を通して描かれているか）
+    - ✅ 読者の期待を超える要素（意外性、感動、興奮など）
+    """)
+
+@st.fragment
+def _render_tab_analysis(project: dict):
+    """分析・改善タブを描画（操作時はこのタブだけを再実行する）"""
+    st.header("📊 分析・改善提案")
+    st.subheader("🚀 作品をより良くするための改善提案")
+    improvement_streamed = False
+    if st.button("💡 総合改善提案を生成", key="generate_improvement_btn"):
+        improvement_streamed = bool(_stream_report(project, _IMPROVEMENT_TEMPLATE, 'improvement_suggestion', "改善提案", "改善提案を生成中...", "改善提案の生成が完了しました。"))
+
+    if 'improvement_suggestion' in st.session_state and not improvement_streamed:
+        st.subheader("改善提案")
+        st.markdown(st.session_state.improvement_suggestion)
+
 def main_app_view():
     # --- サイドバー ---
     st.sidebar.title("🔧 設定")
@@ -616,52 +1763,38 @@ def main_app_view():
     st.sidebar.subheader("🧠 AIモデル設定")
     st.session_state.selected_model_provider = st.sidebar.selectbox(
         "使用するAIモデル",
-        ["Gemini", "OpenAI", "Claude"],
-        index=["Gemini", "OpenAI", "Claude"].index(st.session_state.selected_model_provider)
+        list(_MODEL_NAMES),
+        index=list(_MODEL_NAMES).index(st.session_state.selected_model_provider)
     )
 
+    if st.sidebar.button("🔄 AI応答キャッシュをクリア", help="テーマ・キャラクター詳細・作品全体の章構成・一括生成・AI修正は、同じ入力なら前回の応答を再利用します。これらを再生成させたい場合に押してください（あらすじ・世界観・章・総合診断・改善提案は毎回新しく生成されます）。"):
+        _cached_llm_call.clear()
+        _cached_llm_revision.clear()
+        st.sidebar.success("AI応答のキャッシュをクリアしました。次回の生成は新しく実行されます。")
+
     # ユーザー固有のAPIキー設定フィールド
     st.sidebar.subheader("🔑 APIキー設定")
     current_user = st.session_state.current_user
-    user_api_keys = st.session_state.user_api_keys.get(current_user, {})
 
-    # sidebarの入力フィールドに現在の値を反映させるために session_state を使う
-    # (ユーザーが入力した値を保持するため、secretsの値で直接上書きしない)
-    gemini_key_input = st.sidebar.text_input(
+    # 入力欄は session_state のキー（api_key_<provider>_<user>）に直接紐づけ、
+    # API呼び出し時に get_api_key() で必要な分だけ読み出す
+    st.sidebar.text_input(
         "Google Gemini API Key", 
         type="password", 
-        value=user_api_keys.get('gemini', ''), 
-        key=f"user_gemini_api_key_input_{current_user}",
+        key=f"api_key_gemini_{current_user}",
         help="Gemini 2.0 Flash を使う場合もここに入力します。"
     )
-    openai_key_input = st.sidebar.text_input(
+    st.sidebar.text_input(
         "OpenAI API Key", 
         type="password", 
-        value=user_api_keys.get('openai', ''), 
-        key=f"user_openai_api_key_input_{current_user}"
+        key=f"api_key_openai_{current_user}"
     )
-    claude_key_input = st.sidebar.text_input(
+    st.sidebar.text_input(
         "Anthropic (Claude) API Key", 
         type="password", 
-        value=user_api_keys.get('claude', ''), 
-        key=f"user_claude_api_key_input_{current_user}"
+        key=f"api_key_claude_{current_user}"
     )
-    
-    # 入力されたAPIキーを session_state.user_api_keys に保存
-    if gemini_key_input != user_api_keys.get('gemini'):
-        user_api_keys['gemini'] = gemini_key_input
-    if openai_key_input != user_api_keys.get('openai'):
-        user_api_keys['openai'] = openai_key_input
-    if claude_key_input != user_api_keys.get('claude'):
-        user_api_keys['claude'] = claude_key_input
-
-    st.session_state.user_api_keys[current_user] = user_api_keys
-
 
-    def is_api_key_set():
-        provider = st.session_state.selected_model_provider.lower()
-        # 現在ログインしているユーザーのAPIキーを使用
-        return bool(st.session_state.user_api_keys.get(current_user, {}).get(provider))
 
     # API使用状況表示
     st.sidebar.markdown("---")
@@ -705,7 +1838,7 @@ def main_app_view():
             if new_project_name not in st.session_state.projects:
                 st.session_state.projects[new_project_name] = {
                     'created_at': datetime.now().isoformat(), 'synopsis': '', 'characters': {},
-                    'world_setting': '', 'plot_outline': '', 'chapters': {}, 'genre': '',
+                    'world_setting': '', 'plot_outline': '', 'chapters_meta': [], 'chapters_body': {}, 'genre': '',
                     'target_audience': '', 'theme': '', 'writing_mode': 'manual',
                     'glossary': {}
                 }
@@ -739,10 +1872,10 @@ def main_app_view():
     st.sidebar.markdown("---")
     st.sidebar.subheader("💾 データ管理")
     if st.session_state.projects:
-        project_json_all = json.dumps(st.session_state.projects, ensure_ascii=False, indent=2)
+        # JSON化はボタンが押されたときだけ実行する（毎回の再実行で全プロジェクトを直列化しない）
         st.sidebar.download_button(
             label="📤 全プロジェクトをエクスポート",
-            data=project_json_all,
+            data=functools.partial(serialize_projects, st.session_state.projects),
             file_name="novel_projects_all.json",
             mime="application/json"
         )
@@ -751,14 +1884,23 @@ def main_app_view():
     if uploaded_file is not None:
         if st.sidebar.button("インポート実行"):
             try:
-                imported_data = json.load(uploaded_file)
+                # トップレベルがオブジェクトでない場合、kvitems は何も返さないため先に確認する
+                _, first_event, _ = next(ijson.parse(uploaded_file))
+                if first_event != 'start_map':
+                    raise ijson.JSONError("トップレベルがオブジェクトではありません")
+                uploaded_file.seek(0)
+                # ファイル全体を一度に読み込まず、トップレベルのプロジェクト単位で順に解析する
+                imported_data = {}
+                for project_name, project_data in ijson.kvitems(uploaded_file, '', use_float=True):
+                    # 既存プロジェクトは移行済みのため、新しく取り込んだ分だけ glossary の追加と章データの移行を行う
+                    project_data.setdefault('glossary', {})
+                    migrate_chapters(project_data)
+                    imported_data[project_name] = project_data
+                # 途中で壊れたデータが見つかった場合に一部だけ取り込まれないよう、最後にまとめて反映する
                 st.session_state.projects.update(imported_data)
-                for project_name, project_data in st.session_state.projects.items():
-                    if 'glossary' not in project_data:
-                        project_data['glossary'] = {}
                 st.sidebar.success("インポート完了！")
                 st.rerun()
-            except json.JSONDecodeError:
+            except ijson.JSONError:
                 st.sidebar.error("無効なJSONファイルです。")
             except Exception as e:
                 st.sidebar.error(f"インポートエラー: {e}")
@@ -768,21 +1910,18 @@ def main_app_view():
         project = st.session_state.projects[st.session_state.current_project]
         
         st.subheader("✍️ 執筆モード選択")
-        current_writing_mode = project.get('writing_mode', 'manual')
-        
-        col_radio1, col_radio2, col_radio3 = st.columns(3)
-        with col_radio1:
-            if st.button("🖊️ セルフ執筆", help="自分で執筆します。AIはアイデア出しや推敲に使います。", use_container_width=True):
-                project['writing_mode'] = 'manual'
-                st.rerun()
-        with col_radio2:
-            if st.button("🤖 AI執筆支援", help="AIに生成してもらい、それを基にあなたの創作を広げます。", use_container_width=True):
-                project['writing_mode'] = 'ai'
-                st.rerun()
-        with col_radio3:
-            if st.button("🔄 ハイブリッド", help="手動とAI生成を組み合わせて効率的に進めます。", use_container_width=True):
-                project['writing_mode'] = 'hybrid'
-                st.rerun()
+        current_writing_mode = st.radio(
+            "執筆モード",
+            WRITING_MODES,
+            index=WRITING_MODES.index(project.get('writing_mode', 'manual')),
+            format_func=WRITING_MODE_LABELS.get,
+            captions=[WRITING_MODE_HELP[mode] for mode in WRITING_MODES],
+            horizontal=True,
+            label_visibility="collapsed",
+            # 作品ごとに別の入力欄として扱う（作品を切り替えたときに前の作品の選択が引き継がれないようにする）
+            key=f"writing_mode_{st.session_state.current_project}"
+        )
+        project['writing_mode'] = current_writing_mode
         
         mode_class = ""
         if current_writing_mode == 'manual':
@@ -798,478 +1937,19 @@ def main_app_view():
         st.markdown(f'<div class="writing-mode {mode_class}"><strong>{mode_text}</strong></div>', unsafe_allow_html=True)
         
         tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["📋 企画・設定", "👥 キャラクター", "🗺️ 世界観", "📖 執筆", "🔍 品質チェック", "📊 分析・改善"])
-        
-        with tab1: # 企画・設定
-            st.header("📋 作品企画・基本設定")
-            
-            col1, col2 = st.columns(2)
-            with col1:
-                st.subheader("基本情報")
-                if current_writing_mode == 'manual' or current_writing_mode == 'hybrid':
-                    all_genres = ["異世界ファンタジー", "現代ファンタジー", "学園もの", "SF", "ミステリー", "恋愛", "バトル・アクション", "日常系", "ホラー・サスペンス", "その他"]
-                    genre_index = all_genres.index(project.get('genre', '')) if project.get('genre') in all_genres else 0
-                    project['genre'] = st.selectbox("ジャンル（メイン）", all_genres, index=genre_index)
-                    
-                    all_targets = ["中高生男性", "中高生女性", "大学生・20代男性", "大学生・20代女性", "30代以上", "全年齢", "特定ターゲット"]
-                    target_index = all_targets.index(project.get('target_audience', '')) if project.get('target_audience') in all_targets else 0
-                    project['target_audience'] = st.selectbox("ターゲット読者層", all_targets, index=target_index)
-
-                    project['theme'] = st.text_input("作品テーマ（核となるメッセージ）", value=project.get('theme', ''), placeholder="例：友情の大切さ、成長と自立、愛と犠牲...")
-
-                if current_writing_mode == 'ai' or current_writing_mode == 'hybrid':
-                    st.subheader("🤖 AI自動生成設定")
-                    genre_preference = st.selectbox("好みのジャンル", ["おまかせ", "異世界", "学園", "SF", "恋愛", "バトル", "ファンタジー", "ミステリー"], key="ai_genre_pref")
-                    target_preference = st.selectbox("ターゲット読者", ["おまかせ", "男性向け", "女性向け", "全年齢"], key="ai_target_pref")
-                    tone_preference = st.selectbox("作品の雰囲気", ["おまかせ", "明るい", "シリアス", "コメディ", "ダーク", "感動的", "サスペンスフル"], key="ai_tone_pref")
-                    
-                    if st.button("🎯 AI企画生成"):
-                        if not is_api_key_set():
-                            st.error(f"AI機能を利用するには、サイドバーで{st.session_state.selected_model_provider}のAPIキーを設定してください。")
-                        else:
-                            with st.spinner("企画生成中..."):
-                                genre_map = {"異世界": "異世界ファンタジー", "学園": "学園もの", "SF": "SF", "恋愛": "恋愛", "バトル": "バトル・アクション", "ファンタジー": "現代ファンタジー", "ミステリー": "ミステリー", "おまかせ": "異世界ファンタジー"}
-                                target_map = {"男性向け": "中高生男性", "女性向け": "中高生女性", "全年齢": "全年齢", "おまかせ": "中高生男性"}
-                                project['genre'] = genre_map.get(genre_preference, "その他")
-                                project['target_audience'] = target_map.get(target_preference, "特定ターゲット")
-                                
-                                theme_prompt = f"ジャンル「{project['genre']}」、読者層「{project['target_audience']}」、雰囲気「{tone_preference}」の物語に適した、ライトノベルの読者が興味を惹かれるような魅力的なテーマを1つ、15文字以内で簡潔に提案してください。"
-                                
-                                api_response = call_generative_api(theme_prompt)
-                                if not api_response['text'].startswith("エラー"):
-                                    project['theme'] = api_response['text'].strip()
-                                    st.success("企画を自動生成しました！")
-                                    st.rerun()
-                                else:
-                                    st.error(api_response['text'])
-                                    project['theme'] = "成長と友情の物語"
-                            
-            with col2:
-                st.subheader("あらすじ・コンセプト")
-                if current_writing_mode == 'manual' or current_writing_mode == 'hybrid':
-                    project['synopsis'] = st.text_area("作品あらすじ（200-400文字）", value=project.get('synopsis', ''), height=150, help="読者が最初に見る重要な要素。魅力的で続きが気になる内容に")
-
-                if current_writing_mode == 'ai' or current_writing_mode == 'hybrid':
-                    st.subheader("🤖 AI あらすじ生成")
-                    custom_elements = st.text_area("追加要望（オプション）", placeholder="例：主人公は料理が得意、ドラゴンが登場、切ないラブコメ要素...", height=80, key="synopsis_custom_elements")
-                    if st.button("✨ AIあらすじ生成", key="generate_synopsis_btn"):
-                        if not is_api_key_set():
-                            st.error(f"AI機能を利用するには、サイドバーで{st.session_state.selected_model_provider}のAPIキーを設定してください。")
-                        else:
-                            with st.spinner("あらすじ生成中..."):
-                                ai_synopsis = generate_ai_content("synopsis", project, {"custom_elements": custom_elements})
-                                if not ai_synopsis.startswith("エラー"):
-                                    project['synopsis'] = ai_synopsis
-                                    st.success("あらすじを生成しました！")
-                                    st.rerun()
-                                else:
-                                    st.error(ai_synopsis)
-
-                if project.get('synopsis'):
-                    with st.expander("🔧 あらすじ修正 (AI)"):
-                        synopsis_modification = st.text_area("修正指示", placeholder="例：もっと感動的に、謎めいた要素を追加、主人公の心情を丁寧に...", height=60, key="synopsis_mod")
-                        if st.button("🤖 あらすじを修正", key="modify_synopsis_btn") and synopsis_modification:
-                            if not is_api_key_set():
-                                st.error(f"AI機能を利用するには、サイドバーで{st.session_state.selected_model_provider}のAPIキーを設定してください。")
-                            else:
-                                with st.spinner("修正中..."):
-                                    modified_synopsis = modify_content_with_ai(project['synopsis'], synopsis_modification, "あらすじ")
-                                    if not modified_synopsis.startswith("エラー"):
-                                        st.session_state.modified_synopsis = modified_synopsis
-                                        st.success("修正案が作成されました。内容を確認し、採用ボタンを押してください。")
-                                        st.rerun()
-                                    else:
-                                        st.error(modified_synopsis)
-                    
-                    if 'modified_synopsis' in st.session_state and st.session_state.modified_synopsis:
-                        st.write("#### 修正案の確認")
-                        col_rev1, col_rev2 = st.columns(2)
-                        with col_rev1:
-                            st.write("**修正前**"); st.write(project['synopsis'])
-                        with col_rev2:
-                            st.write("**修正後**"); st.write(st.session_state.modified_synopsis)
-                        
-                        if st.button("✅ 修正版を採用", key="accept_synopsis_mod"):
-                            project['synopsis'] = st.session_state.modified_synopsis
-                            del st.session_state.modified_synopsis
-                            st.success("修正版を採用しました！")
-                            st.rerun()
-
-                    synopsis_score = analyze_synopsis_quality(project['synopsis'])
-                    if synopsis_score >= 80: st.markdown('<div class="quality-indicator quality-high">✅ あらすじ品質: 高</div>', unsafe_allow_html=True)
-                    elif synopsis_score >= 60: st.markdown('<div class="quality-indicator quality-medium">⚠️ あらすじ品質: 中（改善推奨）</div>', unsafe_allow_html=True)
-                    else: st.markdown('<div class="quality-indicator quality-low">❌ あらすじ品質: 低（要改善）</div>', unsafe_allow_html=True)
 
+        with tab1: # 企画・設定
+            _render_tab_plan(project, current_writing_mode)
         with tab2: # キャラクター
-            st.header("👥 キャラクター設定")
-            st.subheader("既存キャラクター")
-            if not project.get('characters'):
-                st.info("まだキャラクターは登録されていません。")
-            else:
-                for name, data in project['characters'].items():
-                    with st.expander(f"👤 {name} ({data.get('role', '役割不明')})"):
-                        st.write(f"**役割:** {data.get('role', '未設定')}")
-                        st.write(f"**性格:** {data.get('personality', '未設定')}")
-                        st.write(f"**背景:** {data.get('background', '未設定')}")
-                        st.write(f"**外見:** {data.get('appearance', '未設定')}")
-                        st.write(f"**口調:** {data.get('speech', '未設定')}")
-                        if st.button(f"{name} の詳細をAIで編集", key=f"edit_char_{name}"):
-                            st.session_state.editing_character = name
-                            st.rerun()
-
-            st.subheader("新キャラクター作成")
-            col_char_name, col_char_role, col_char_mode = st.columns([2, 2, 1])
-            with col_char_name: new_char_name = st.text_input("キャラクター名", key="new_char_name_input")
-            with col_char_role: new_char_role = st.selectbox("役割", ["主人公", "ヒロイン", "ライバル", "親友", "師匠", "敵役", "サポート", "その他"], key="new_char_role_select")
-            with col_char_mode: char_creation_mode = st.radio("作成方法", ["✋ 手動", "🤖 AI"], key="char_creation_mode_radio")
-
-            char_details_input = ""
-            if char_creation_mode == "🤖 AI":
-                char_details_input = st.text_area("キャラクター詳細要望（AI生成用）", placeholder="例：クールで無口、実は情深い、剣術が得意、過去に因縁あり...", height=80, key="char_ai_details")
-            
-            if st.button("➕ キャラクターを追加", key="add_character_btn"):
-                if new_char_name and (char_creation_mode == "✋ 手動" or char_details_input):
-                    if new_char_name not in project['characters']:
-                        char_data = {'role': new_char_role}
-                        if char_creation_mode == "✋ 手動":
-                            char_data['details'] = "手動入力用の詳細欄を追加してください。"
-                        elif char_creation_mode == "🤖 AI":
-                            if not is_api_key_set():
-                                st.error(f"AI機能を利用するには、サイドバーで{st.session_state.selected_model_provider}のAPIキーを設定してください。")
-                            else:
-                                with st.spinner("キャラクター生成中..."):
-                                    full_char_prompt = f"""
-以下の情報を基に、ライトノベルのキャラクター設定を詳細に生成してください。
-キャラクター名: {new_char_name}
-役割: {new_char_role}
-要望: {char_details_input}
-
-生成項目:
-1. 詳細な性格設定（長所、短所、癖など）
-2. 背景・過去（物語に影響を与える要素）
-3. 目標・動機
-4. 外見的特徴（髪の色、目の色、体格、服装など）
-5. 口調・話し方
-6. 他キャラクターとの関係性（想定されるもの）
-7. そのキャラクターを表す象徴的なアイテムや能力（あれば）
-
-読者に愛されるような、深みのあるキャラクター設定を作成してください。
-"""
-                                    api_response = call_generative_api(full_char_prompt)
-                                    if not api_response['text'].startswith("エラー"):
-                                        char_data['details'] = api_response['text']
-                                        st.success(f"キャラクター「{new_char_name}」をAIで生成しました！")
-                                        st.rerun()
-                                    else:
-                                        st.error(api_response['text'])
-                                        char_data['details'] = "AI生成に失敗しました。"
-                        
-                        project['characters'][new_char_name] = char_data
-                        st.success(f"キャラクター「{new_char_name}」を追加しました。")
-                        st.rerun()
-                    else:
-                        st.warning(f"キャラクター「{new_char_name}」は既に存在します。")
-                else:
-                    st.warning("キャラクター名と、手動入力またはAI生成のための情報が必要です。")
-
-            if 'editing_character' in st.session_state and st.session_state.editing_character:
-                char_to_edit = st.session_state.editing_character
-                char_data_orig = project['characters'][char_to_edit]
-                
-                with st.dialog(f"{char_to_edit} の詳細を編集", key="edit_char_dialog"):
-                    edited_char_name = st.text_input("キャラクター名", value=char_to_edit, key=f"edit_name_{char_to_edit}")
-                    edited_char_role = st.selectbox("役割", ["主人公", "ヒロイン", "ライバル", "親友", "師匠", "敵役", "サポート", "その他"], index=["主人公", "ヒロイン", "ライバル", "親友", "師匠", "敵役", "サポート", "その他"].index(char_data_orig.get('role', 'その他')), key=f"edit_role_{char_to_edit}")
-                    edited_char_details = st.text_area("詳細設定", value=char_data_orig.get('details', ''), key=f"edit_details_{char_to_edit}", height=300)
-
-                    if st.button("変更を保存", key=f"save_char_{char_to_edit}"):
-                        if edited_char_name not in project['characters'] or edited_char_name == char_to_edit:
-                            project['characters'][edited_char_name] = {
-                                'role': edited_char_role,
-                                'details': edited_char_details
-                            }
-                            if edited_char_name != char_to_edit:
-                                del project['characters'][char_to_edit]
-                            
-                            del st.session_state.editing_character
-                            st.success(f"キャラクター「{edited_char_name}」を更新しました。")
-                            st.rerun()
-                        else:
-                            st.warning(f"キャラクター「{edited_char_name}」は既に存在します。")
-
-                    if st.button("キャンセル", key=f"cancel_char_{char_to_edit}"):
-                        del st.session_state.editing_character
-                        st.rerun()
-
+            _render_tab_characters(project)
         with tab3: # 世界観
-            st.header("🗺️ 世界観設定")
-            if current_writing_mode == 'manual' or current_writing_mode == 'hybrid':
-                st.subheader("基本世界観設定")
-                project['world_setting'] = st.text_area("世界観の詳細", value=project.get('world_setting', ''), height=300, help="物語の舞台となる世界の背景、ルール、特徴などを記述します。")
-
-            if current_writing_mode == 'ai' or current_writing_mode == 'hybrid':
-                st.subheader("🤖 AI 世界観生成")
-                world_elements = st.text_area("世界観に追加したい要素（任意）", placeholder="例：魔法体系、国家間の関係、主要な産業...", height=80, key="world_elements_input")
-                if st.button("🌍 AI世界観生成", key="generate_world_btn"):
-                    if not is_api_key_set():
-                        st.error(f"AI機能を利用するには、サイドバーで{st.session_state.selected_model_provider}のAPIキーを設定してください。")
-                    else:
-                        with st.spinner("世界観生成中..."):
-                            ai_world_setting = generate_ai_content("world_setting", project, {"world_elements": world_elements})
-                            if not ai_world_setting.startswith("エラー"):
-                                project['world_setting'] = ai_world_setting
-                                st.success("世界観を生成しました！")
-                                st.rerun()
-                            else:
-                                st.error(ai_world_setting)
-
-            if project.get('world_setting'):
-                with st.expander("🔧 世界観の推敲・修正 (AI)"):
-                    world_modification = st.text_area("修正指示", placeholder="例：ファンタジー要素を強く、科学技術レベルを詳細に...", height=60, key="world_mod")
-                    if st.button("🤖 世界観を修正", key="modify_world_btn") and world_modification:
-                        if not is_api_key_set():
-                            st.error(f"AI機能を利用するには、サイドバーで{st.session_state.selected_model_provider}のAPIキーを設定してください。")
-                        else:
-                            with st.spinner("修正中..."):
-                                modified_world = modify_content_with_ai(project['world_setting'], world_modification, "世界観")
-                                if not modified_world.startswith("エラー"):
-                                    st.session_state.modified_world = modified_world
-                                    st.success("修正案が作成されました。内容を確認し、採用ボタンを押してください。")
-                                    st.rerun()
-                                else:
-                                    st.error(modified_world)
-                
-                if 'modified_world' in st.session_state and st.session_state.modified_world:
-                    st.write("#### 修正案の確認")
-                    col_world_rev1, col_world_rev2 = st.columns(2)
-                    with col_world_rev1:
-                        st.write("**修正前**"); st.write(project['world_setting'])
-                    with col_world_rev2:
-                        st.write("**修正後**"); st.write(st.session_state.modified_world)
-                    
-                    if st.button("✅ 修正版を採用", key="accept_world_mod"):
-                        project['world_setting'] = st.session_state.modified_world
-                        del st.session_state.modified_world
-                        st.success("修正版を採用しました！")
-                        st.rerun()
-
+            _render_tab_world(project, current_writing_mode)
         with tab4: # 執筆
-            st.header("📖 執筆・原稿管理")
-            
-            execution_mode = st.radio("執筆方法を選択してください", ["📝 章ごと執筆", "📚 作品全体をAIで生成"], key="writing_tab_mode", horizontal=True)
-
-            if execution_mode == "📝 章ごと執筆":
-                st.subheader("章ごとの執筆")
-                chapter_name = st.text_input("章のタイトル / 番号", value=project.get('current_chapter_name', ''))
-                plot_outline = st.text_area("この章のプロット概要", value=project.get('current_chapter_plot', ''), height=100)
-                target_length = st.text_input("目標文字数", value=project.get('current_chapter_length', '3000-5000字'))
-                writing_style = st.selectbox("文体", ["三人称", "一人称"], index=0 if project.get('current_chapter_style', '三人称') == '三人称' else 1)
-
-                if st.button("✍️ この章を執筆", key="write_chapter_btn"):
-                    if not chapter_name or not plot_outline:
-                        st.warning("章のタイトルとプロット概要を入力してください。")
-                    else:
-                        project['current_chapter_name'] = chapter_name
-                        project['current_chapter_plot'] = plot_outline
-                        project['current_chapter_length'] = target_length
-                        project['current_chapter_style'] = writing_style
-
-                        if not is_api_key_set():
-                            st.error(f"AI機能を利用するには、サイドバーで{st.session_state.selected_model_provider}のAPIキーを設定してください。")
-                        else:
-                            with st.spinner("執筆中..."):
-                                chapter_content = generate_ai_content("chapter", project, {
-                                    "chapter_name": chapter_name,
-                                    "chapter_plot": plot_outline,
-                                    "target_length": target_length,
-                                    "writing_style": writing_style
-                                })
-                                if not chapter_content.startswith("エラー"):
-                                    project['chapters'][chapter_name] = chapter_content
-                                    st.success(f"「{chapter_name}」の執筆が完了しました！")
-                                    st.rerun()
-                                else:
-                                    st.error(chapter_content)
-                
-                st.subheader("執筆済み章一覧")
-                if not project['chapters']:
-                    st.info("まだ章は執筆されていません。")
-                else:
-                    for chap_name, chap_content in project['chapters'].items():
-                        with st.expander(f"📖 {chap_name}"):
-                            st.text_area(f"{chap_name} の内容", value=chap_content, height=200, key=f"chapter_content_{chap_name}")
-                            if st.button(f"{chap_name} をAIで修正・追記", key=f"edit_chapter_{chap_name}"):
-                                st.session_state.editing_chapter_content = chap_content
-                                st.session_state.editing_chapter_name = chap_name
-                                st.rerun()
-
-            elif execution_mode == "📚 作品全体をAIで生成":
-                st.subheader("📚 作品全体をAIで生成")
-                total_length = st.text_input("希望する総文字数", value=project.get('full_story_length', '10000-15000字'))
-                chapter_count = st.text_input("希望する章数", value=project.get('full_story_chapters', '3-5章'))
-                full_writing_style = st.selectbox("文体", ["三人称", "一人称"], index=0 if project.get('full_story_style', '三人称') == '三人称' else 1, key="full_story_style_select")
-                
-                if st.button("🎭 作品全体を生成", type="primary", key="generate_full_story_btn"):
-                    if not is_api_key_set():
-                        st.error(f"AI機能を利用するには、サイドバーで{st.session_state.selected_model_provider}のAPIキーを設定してください。")
-                    else:
-                        with st.spinner("作品全体を生成中... 少々お待ちください。"):
-                            full_story_content = generate_ai_content("full_story", project, {
-                                "target_length": total_length,
-                                "chapter_count": chapter_count,
-                                "writing_style": full_writing_style
-                            })
-                            if not full_story_content.startswith("エラー"):
-                                project['chapters'] = {"全体生成結果": full_story_content}
-                                project['full_story_length'] = total_length
-                                project['full_story_chapters'] = chapter_count
-                                project['full_story_style'] = full_writing_style
-                                
-                                st.success("作品全体の生成が完了しました！「執筆済み章一覧」で確認できます。")
-                                st.rerun()
-                            else:
-                                st.error(full_story_content)
-            
-            if 'editing_chapter_content' in st.session_state and st.session_state.editing_chapter_name:
-                chapter_name_to_edit = st.session_state.editing_chapter_name
-                original_content = st.session_state.editing_chapter_content
-                
-                with st.dialog(f"「{chapter_name_to_edit}」の内容を編集", key="edit_chapter_dialog"):
-                    edited_chapter_content = st.text_area("編集内容", value=original_content, height=400, key=f"edit_chapter_text_{chapter_name_to_edit}")
-                    
-                    modification_instruction = st.text_area("AIによる修正指示（任意）", placeholder="例：この部分をもっと詳しく描写してほしい、セリフを変更してほしい...", height=80, key=f"edit_chapter_instruction_{chapter_name_to_edit}")
-                    
-                    col_edit_save, col_edit_cancel, col_edit_ai_modify = st.columns(3)
-                    
-                    with col_edit_save:
-                        if st.button("変更を保存", key=f"save_chapter_edit_{chapter_name_to_edit}"):
-                            project['chapters'][chapter_name_to_edit] = edited_chapter_content
-                            del st.session_state.editing_chapter_content
-                            del st.session_state.editing_chapter_name
-                            st.success("章の内容を保存しました。")
-                            st.rerun()
-                    with col_edit_cancel:
-                        if st.button("キャンセル", key=f"cancel_chapter_edit_{chapter_name_to_edit}"):
-                            del st.session_state.editing_chapter_content
-                            del st.session_state.editing_chapter_name
-                            st.rerun()
-                    with col_edit_ai_modify:
-                        if st.button("🤖 AIで修正", key=f"ai_modify_chapter_{chapter_name_to_edit}") and modification_instruction:
-                            if not is_api_key_set():
-                                st.error(f"AI機能を利用するには、サイドバーで{st.session_state.selected_model_provider}のAPIキーを設定してください。")
-                            else:
-                                with st.spinner("AIで修正中..."):
-                                    modified_content = modify_content_with_ai(original_content, modification_instruction, "章の内容")
-                                    if not modified_content.startswith("エラー"):
-                                        st.session_state.editing_chapter_content = modified_content
-                                        st.success("修正案が作成されました。内容を確認し、「変更を保存」または「キャンセル」を選択してください。")
-                                        st.rerun()
-                                    else:
-                                        st.error(modified_content)
-
+            _render_tab_writing(project)
         with tab5: # 品質チェック
-            st.header("🔍 品質チェック・診断")
-            st.subheader("作品の総合診断")
-            if st.button("📊 作品総合診断を実行", key="run_diagnosis_btn"):
-                if not is_api_key_set():
-                    st.error(f"AI機能を利用するには、サイドバーで{st.session_state.selected_model_provider}のAPIキーを設定してください。")
-                else:
-                    with st.spinner("総合診断中..."):
-                        diagnosis_prompt = f"""
-あなたは経験豊富なライトノベルの編集者です。以下の作品設定とあらすじ、キャラクター情報を分析し、読者を惹きつけるレベルに達しているか、多角的な視点から評価・診断してください。
-
-【作品基本情報】
-ジャンル: {project.get('genre', '未設定')}
-ターゲット読者: {project.get('target_audience', '未設定')}
-テーマ: {project.get('theme', '未設定')}
-あらすじ: {project.get('synopsis', '未設定')}
-世界観: {project.get('world_setting', '未設定')[:1000]}
-キャラクター（抜粋）:
-{json.dumps({k:v.get('role') for k,v in list(project.get('characters', {}).items())[:5]}, indent=2, ensure_ascii=False)}
-
-【評価項目】
-1.  **作品の魅力・独自性**: どれだけ読者の興味を引き、他作品との差別化ができているか。
-2.  **ストーリー展開**: プロットの面白さ、テンポ、伏線、クリフハンガーの適切さ。
-3.  **キャラクターの魅力**: 主人公や主要キャラクターの造形の深さ、共感性、成長性。
-4.  **世界観のリアリティ・魅力**: 設定の緻密さ、想像力、物語との整合性。
-5.  **文章力・表現力**: 読みやすさ、描写の豊かさ、感情表現の巧みさ。
-6.  **ターゲット読者への訴求力**: 設定や展開がターゲット層に響いているか。
-7.  **全体的な完成度・商業性**: ライトノベルとして市場に受け入れられる可能性。
-
-各項目について、5段階評価（★☆☆☆☆ ～ ★★★★★）で評価し、具体的な改善点を提案してください。最も改善が必要な点、そして作品の強みを明確にしてください。
-"""
-                        api_response = call_generative_api(diagnosis_prompt)
-                        if not api_response['text'].startswith("エラー"):
-                            st.session_state.diagnosis_result = api_response['text']
-                            st.success("作品総合診断が完了しました。結果を表示します。")
-                            st.rerun()
-                        else:
-                            st.error(api_response['text'])
-            
-            if 'diagnosis_result' in st.session_state:
-                st.subheader("診断結果")
-                st.markdown(st.session_state.diagnosis_result)
-
-            st.markdown("---")
-            st.subheader("ライトノベル要素チェックリスト")
-            st.markdown("""
-            ### 🎯 魅力的な作品のためのチェックリスト
-            **基本要件**
-            - ✅ 十分な文字数（例: 50,000文字以上）
-            - ✅ 魅力的なキャラクター設定（主人公に共感できるか）
-            - ✅ 読者を引き込む書き出し（冒頭数ページで興味を引くか）
-            - ✅ 一貫性のある世界観と設定（矛盾がないか）
-            - ✅ 読者層に響くテーマやメッセージ（ターゲットに刺さるか）
-            
-            **品質要件**
-            - ✅ 完成度の高い文章力（読みやすいか、誤字脱字はないか）
-            - ✅ 魅力的な描写力（情景、感情、心理描写など）
-            - ✅ ストーリー展開のテンポ（飽きさせないか、盛り上がりがあるか）
-            - ✅ キャラクターの魅力と成長（魅力的で、物語を通して変化するか）
-            - ✅ 世界観の独自性・面白さ（魅力的で、物語に深みを与えているか）
-            - ✅ テーマの掘り下げ（テーマが物語全体を通して描かれているか）
-            - ✅ 読者の期待を超える要素（意外性、感動、興奮など）
-            """)
-
+            _render_tab_quality(project)
         with tab6: # 分析・改善
-            st.header("📊 分析・改善提案")
-            st.subheader("🚀 作品をより良くするための改善提案")
-            if st.button("💡 総合改善提案を生成", key="generate_improvement_btn"):
-                if not is_api_key_set():
-                    st.error(f"AI機能を利用するには、サイドバーで{st.session_state.selected_model_provider}のAPIキーを設定してください。")
-                else:
-                    with st.spinner("改善提案を生成中..."):
-                        improvement_prompt = f"""
-あなたはライトノベルの専門家であり、プロの編集者です。以下の作品情報を基に、読者にさらに愛される作品にするための具体的な改善提案を行ってください。
-
-【作品情報】
-ジャンル: {project.get('genre', '未設定')}
-ターゲット読者: {project.get('target_audience', '未設定')}
-テーマ: {project.get('theme', '未設定')}
-あらすじ: {project.get('synopsis', '未設定')}
-世界観: {project.get('world_setting', '未設定')[:1000]}
-主要キャラクター（抜粋）:
-{json.dumps({k:v.get('role') for k,v in list(project.get('characters', {}).items())[:5]}, indent=2, ensure_ascii=False)}
-
-【改善提案の観点】
-1.  **読者のエンゲージメント向上**: 読者が物語にさらに没入し、キャラクターに感情移入できるよう、どのような要素を加えるべきか。
-2.  **ストーリーのフック強化**: プロットに更なる魅力を加えるためのアイデア（伏線、どんでん返し、葛藤の深化など）。
-3.  **キャラクターアークの深化**: キャラクターに更なる深みや成長を与えるための要素。
-4.  **世界観の活用**: 設定を物語の面白さにどう活かすか、深掘りすべき点。
-5.  **テーマの強調**: 作品のテーマを読者に強く印象付けるための方法。
-6.  **ライトノベルとしての独自性**: 他作品との差別化を図り、読者の記憶に残る作品にするための工夫。
-
-これらの観点に基づき、具体的で実践的な改善策を提案してください。
-"""
-                        api_response = call_generative_api(improvement_prompt)
-                        if not api_response['text'].startswith("エラー"):
-                            st.session_state.improvement_suggestion = api_response['text']
-                            st.success("改善提案の生成が完了しました。")
-                            st.rerun()
-                        else:
-                            st.error(api_response['text'])
-
-            if 'improvement_suggestion' in st.session_state:
-                st.subheader("改善提案")
-                st.markdown(st.session_state.improvement_suggestion)
+            _render_tab_analysis(project)
 
     else:
         st.info("📁 左サイドバーから新規プロジェクトを作成するか、既存プロジェクトを選択してください。")